@@ -0,0 +1,122 @@
+"""Benchmark of target recognition over a recorded corpus of frames.
+
+Every frame is passed through recognition.TargetIdentifier.find_target
+and the time of each of its stages is recorded. The report gives the
+p50/p95/p99 latency of each stage and of the whole call in
+milliseconds, the frames per second and the fraction of frames in
+which a target was found, as JSON so runs can be compared between
+commits.
+
+USAGE: python benchmark.py frames/ --output before.json
+       python benchmark.py frames.npz --scale 0.5 --compare before.json
+
+A corpus is a directory of images, an .npz file with an array of BGR
+frames named 'frames' or a video.FrameStore (.frames), which is read
+from disk as it's replayed rather than loaded into memory.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+import numpy as np
+import cv2
+import recognition
+
+def load_corpus(path):
+    """Load the frames of a corpus as a sequence of BGR images"""
+    if path.endswith('.frames'):
+        # video needs the H.264 decoder, only import it for a FrameStore
+        import video
+        return video.FrameStore(path)
+    if os.path.isdir(path):
+        names = sorted(glob.glob(os.path.join(path, '*')))
+        frames = [cv2.imread(name) for name in names]
+        return [frame for frame in frames if frame is not None]
+    with np.load(path) as corpus:
+        return list(corpus['frames'])
+
+def latency_stats(seconds):
+    """Summarise a list of durations (s) in milliseconds"""
+    ms = 1000 * np.asarray(seconds)
+    p50, p95, p99 = np.percentile(ms, (50, 95, 99))
+    return {'p50': p50, 'p95': p95, 'p99': p99, 'mean': ms.mean()}
+
+def run(frames, identifier, repeat=1):
+    """Replay the frames through the identifier and return the report"""
+    stages = {}
+    totals = []
+    hits = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for frame in frames:
+            # find_target draws on the frame, keep the corpus clean
+            frame = frame.copy()
+            before = time.perf_counter()
+            target = identifier.find_target(frame)
+            totals.append(time.perf_counter() - before)
+            hits += target is not None
+            for stage, seconds in identifier.timings.items():
+                stages.setdefault(stage, []).append(seconds)
+    elapsed = time.perf_counter() - start
+
+    count = len(totals)
+    return {'frames': count,
+            'fps': count / elapsed,
+            'hit_rate': hits / count,
+            'total': latency_stats(totals),
+            'stages': {stage: latency_stats(seconds) for stage, seconds in stages.items()}}
+
+def compare(report, previous):
+    """Print the change of each p50 latency relative to a previous report"""
+    rows = [('total', report['total'], previous.get('total'))]
+    rows += [(stage, stats, previous['stages'].get(stage))
+             for stage, stats in report['stages'].items()]
+    for name, stats, before in rows:
+        if before:
+            print('{:12} p50 {:8.2f} ms  was {:8.2f} ms  ({:+.0%})'.format(
+                name, stats['p50'], before['p50'], stats['p50'] / before['p50'] - 1))
+    print('{:12} {:.2f}  was {:.2f}'.format('hit rate', report['hit_rate'], previous['hit_rate']))
+
+def get_arguments():
+    ap = argparse.ArgumentParser(description='Benchmark target recognition on recorded frames')
+    ap.add_argument('corpus', help='Directory of images or .npz file of frames')
+    ap.add_argument('--outer', default='fuschia', help='Color of the outer square')
+    ap.add_argument('--inner', default='blue', help='Color of the inner square')
+    ap.add_argument('--scale', type=float, default=1.0, help='Downscaling for coarse detection')
+    ap.add_argument('--tracking', action='store_true', help='Use region of interest tracking')
+    ap.add_argument('--workers', type=int, default=0, help='Threads for per-color detection')
+    ap.add_argument('--repeat', type=int, default=1, help='Times to replay the corpus')
+    ap.add_argument('-o', '--output', help='Write the report to this file')
+    ap.add_argument('-c', '--compare', help='Previous report to compare with')
+    return ap.parse_args()
+
+def main():
+    args = get_arguments()
+    frames = load_corpus(args.corpus)
+    if not len(frames):
+        raise SystemExit('No frames found in {}'.format(args.corpus))
+
+    identifier = recognition.TargetIdentifier(args.outer, args.inner,
+                                              tracking=args.tracking,
+                                              scale=args.scale,
+                                              workers=args.workers)
+    report = run(frames, identifier, args.repeat)
+    identifier.close()
+    report['config'] = {'corpus': args.corpus, 'outer': args.outer, 'inner': args.inner,
+                        'scale': args.scale, 'tracking': args.tracking,
+                        'workers': args.workers, 'repeat': args.repeat}
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,26 @@
 import functools
+import asyncio
+import json
+import os
 import time
 import multiprocessing
 import threading
 import numpy as np
 import cv2
 from network import Network, NoNetwork
-from video import Webcam, Video, VideoDisplayer
+from video import Webcam, Video, ProcessVideo, ReplayVideo, VideoDisplayer
+from telemetry import Telemetry
+from recorder import FlightRecorder
+from profiles import ProfileWatcher
 import planner
 import controller
 import recognition
 import fsm
 
+# When set, every Drone is a planner whatever kind of drone is asked
+# for, so that mission scripts can be checked without flying
+planner_only = False
+
 # decorators for putting constraints on arguments passed to drone
 # class methods
 def force_integer_arguments(func):
@@ -31,6 +41,8 @@ def ensure_valid_range(minimum, maximum):
             else:
                 msg = 'Error in {}({}): argument must be between {} and {}'
                 raise RuntimeError(msg.format(func.__name__, ', '.join(map(str, args)), minimum, maximum))
+        # let validators look up the range of each command
+        wrapper.valid_range = (minimum, maximum)
         return wrapper
     return decorator
 
@@ -41,31 +53,79 @@ class Drone:
 setting the 'which' argument to:
 
 planner: plots planned flight path of drone
+planner-live: plots the flight path of the drone as it's planned
 webcam:  simulated drone using the webcam
 drone:   Tello EDU drone using the network
+swarm:   one Tello EDU of a swarm.Swarm, commands only, using the given
+         network
+replay:  simulated drone that replays the video of a recorded flight,
+         the H.264 file or recorder.FlightRecorder log given as replay
+         (see video.ReplayVideo), as fast as it's processed
+
+With decode_in_process set, the drone's video stream is received and
+decoded in a separate process (see video.ProcessVideo).
+
+With record set to a file name, e.g. 'flight.log', the flight is
+recorded to a recorder.FlightRecorder log: commands, telemetry, the
+video stream and what align_to_target sees. When decoding in a
+separate process, the video is recorded to a log of its own with
+'-video' added to the name.
+
+With profile set to a profiles.py JSON file, its thresholds and FSM
+parameters are used by align_to_target and reloaded whenever the file
+changes.
 
     """
-    def __init__(self, which='webcam'):
+    def __init__(self, which='webcam', decode_in_process=False, network=None, record=None,
+                 replay=None, profile=None):
+        if planner_only:
+            which = 'planner'
         self.which = which
+        self.telemetry = None
+        self.recorder = FlightRecorder(record) if record else None
+        self.profile = ProfileWatcher(profile) if profile else None
         if which == 'planner':
             self.network = self.video = planner.Planner()
             self.displayer = None
 
+        elif which == 'planner-live':
+            self.network = self.video = planner.Planner(live=True)
+            self.displayer = None
+
         elif which == 'webcam':
             self.network = NoNetwork()
             self.video = Webcam()
-            self.displayer = VideoDisplayer(self.video)
+            self.displayer = VideoDisplayer(self.video, shape=self.video.shape)
             
         elif which == 'drone':
-            self.network = Network()
-            self.video = Video()
+            self.network = Network(recorder=self.recorder)
+            if decode_in_process:
+                video_log = None
+                if record:
+                    root, ext = os.path.splitext(record)
+                    video_log = root + '-video' + ext
+                self.video = ProcessVideo(record=video_log)
+            else:
+                self.video = Video(recorder=self.recorder)
             self.displayer = VideoDisplayer(self.video)
-            
+            self.telemetry = Telemetry(recorder=self.recorder)
+
+        elif which == 'swarm':
+            self.network = network
+            self.video = None
+            self.displayer = None
+
+        elif which == 'replay':
+            self.network = NoNetwork()
+            self.video = ReplayVideo(replay)
+            self.displayer = None
+
         else:
             raise "Unrecognized option: {}".format(which)
 
         self.stop()
-        self.network.sendrecv('streamon')
+        if self.video is not None:
+            self.network.sendrecv('streamon')
 
     def __enter__(self):
         """Prompt the drone to receive text commands at the beginning of a
@@ -78,25 +138,54 @@ with-statement"""
 of a with-statement when an error occurs
 
         """
-        self.land()
-        self.network.close()
-        self.video.stop()
+        if exc_type is not None and self.which.startswith('planner'):
+            # keep the reason the mission was cut short for validation
+            self.network.error = exc_value
+
+        try:
+            self.land()
+        finally:
+            self.network.close()
+            if self.displayer is not None:
+                self.displayer.stop()
+            if self.video is not None:
+                self.video.stop()
+            if self.telemetry is not None:
+                self.telemetry.stop()
+            if self.recorder is not None:
+                self.recorder.close()
+            if self.profile is not None:
+                self.profile.stop()
 
         if exc_type is not None:
             print(exc_value)
             return True
 
+    async def cmd(self, command):
+        """Send a command and wait for its response without blocking the
+caller's event loop, e.g. battery = await drone.cmd('battery?').
+Responses to queries are parsed into numbers."""
+        return await asyncio.wrap_future(self.network.submit(command))
+
     def speed(self):
         """Ask for the current speed (cm/s)"""
-        self.network.sendrecv('speed?')
+        return self.network.sendrecv('speed?')
+
+    def state(self, name, query):
+        """Return the latest value of a telemetry field if the drone has
+broadcast it recently, otherwise ask the drone with the query command"""
+        value = None if self.telemetry is None else self.telemetry.get(name)
+        if value is None:
+            return self.network.sendrecv(query)
+        return int(value)
 
     def battery(self):
         """Ask for the battery charge percentage"""
-        self.network.sendrecv('battery?')
+        return self.state('bat', 'battery?')
 
     def time(self):
         """Ask for the accumulated flight time (s)"""
-        self.network.sendrecv('time?')
+        return self.state('time', 'time?')
         
     def takeoff(self):
         """Tell the drone to takeoff and hover in place"""
@@ -121,7 +210,8 @@ immediately fall to the ground!
     def wait(self, seconds):
         """Tell the drone to pause for the specified number of seconds. Valid
 durations are between 0 and 15."""
-        time.sleep(seconds)
+        if self.which not in ('planner', 'planner-live', 'replay'): # these don't fly
+            time.sleep(seconds)
 
     @force_integer_arguments
     @ensure_valid_range(20, 500)
@@ -212,29 +302,61 @@ you must call rc(0, 0, 0, 0) or stop().
 
     def align_to_target(self):
         """Align the drone to the first target seen"""
-        if self.which == 'planner':
+        if self.which in ('planner', 'planner-live', 'swarm'):
             return
 
         control = controller.DroneController(self)
         color_outer = 'fuschia'
         color_inner = 'blue'
-        identifier = recognition.TargetIdentifier(color_outer, color_inner)
-        aligner = fsm.AlignmentFSM(identifier, control)
+        identifier = recognition.TargetIdentifier(color_outer, color_inner,
+                                                  tracking=True)
 
         # pause the fast running VideoDisplayer thread since we want
         # to sync up frames received and the calculation and display
         # of target data
-        self.displayer.pause() 
-        while True:
-            frame = self.video.get_frame()
-            if aligner.on_frame(frame) is None:
-                # succeeded in alignment
-                break
-
-            # send to VideoDisplayer a single frame that has overlay
-            # of target data
-            self.displayer.send_single_frame(frame)
-
-        # resume fast running VideoDisplayer thread
-        self.displayer.resume()
+        if self.displayer is not None:
+            self.displayer.pause()
+
+        result = self.video.wait_for_next_frame()
+        clock = fsm.clock
+        if self.which == 'replay':
+            # timeouts and control follow the time the frame being
+            # processed was recorded, however fast it's replayed
+            fsm.clock = lambda: result[1]
+        try:
+            if result is not None: # a replayed recording may have no frames
+                aligner = fsm.AlignmentFSM(identifier, control, self.profile)
+            # process every frame exactly once, until a replayed
+            # recording ends
+            while result is not None:
+                frame_id, _, frame = result
+                state = aligner.on_frame(frame)
+                if self.recorder is not None:
+                    self.record_target(frame_id, state, aligner.target)
+                if state is None:
+                    # succeeded in alignment
+                    break
+
+                # send to VideoDisplayer a single frame that has overlay
+                # of target data
+                if self.displayer is not None:
+                    self.displayer.send_single_frame(frame)
+                result = self.video.wait_for_next_frame(frame_id)
+        finally:
+            fsm.clock = clock
+
+            # resume fast running VideoDisplayer thread
+            if self.displayer is not None:
+                self.displayer.resume()
+
+    def record_target(self, frame_id, state, target):
+        """Record the target found in a frame and the state of the FSM"""
+        result = {'frame_id': frame_id,
+                  'state': type(state).__name__ if state else None,
+                  'target': None}
+        if target:
+            result['target'] = {'dx': int(target.dx), 'dy': int(target.dy),
+                                'distance': float(target.distance),
+                                'ratio': float(target.ratio)}
+        self.recorder.record('target', json.dumps(result))
 
@@ -7,6 +7,9 @@ import recognition
 no_target_frame_count = 10
 timeout = 10
 
+# Source of the current time (s) for timeouts, replaced by simulations
+clock = time.monotonic
+
 
 # Parameters to adjust when target alignment goals are met
 radius_centered = 50
@@ -16,6 +19,22 @@ ratio_min = 0.95
 ratio_max = 1.05
 
 
+# How the drone is moved towards the goals. 'bang_bang' moves one axis
+# at a time with fixed rc values (LookAt, FlyTo then Strafe), 'pid'
+# moves all axes at once with rc values from PID controllers (Approach)
+control_mode = 'bang_bang'
+
+# (kp, ki, kd) of the PID controller of each rc axis, acting on the
+# error of the measurement from the middle of its goal: dx and dy
+# (pixels), distance (m) and ratio
+pid_gains = {'yaw': (0.08, 0.0, 0.01),
+             'up_down': (0.1, 0.0, 0.01),
+             'forward_backward': (30.0, 0.0, 5.0),
+             'left_right': (800.0, 0.0, 50.0)}
+pid_limit = 40 # largest rc value a PID controller sends
+pid_smoothing = 0.7 # weight of the previous derivative in its low pass filter
+
+
 # Functions that determine if goals are met
 def target_centered(dx, dy):
     """Calculates whether the target is centered in the drone's view"""
@@ -31,6 +50,55 @@ def good_left_right(ratio):
 
 
 
+def tracking_state(controller):
+    """State that moves the drone towards the goals once the target is
+seen, depending on control_mode"""
+    if control_mode == 'pid':
+        return Approach(controller)
+    return LookAt(controller)
+
+
+class PID:
+    """Proportional-integral-derivative controller of one rc axis.
+
+update() takes the error of a measurement and the time (s) it was made
+and returns an rc value clamped to [-limit, limit]. The derivative is
+low pass filtered, since it amplifies the noise of recognition, and
+the integral is clamped so it alone can't exceed the limit.
+
+    """
+    def __init__(self, kp, ki=0.0, kd=0.0, limit=100, smoothing=0.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.limit = limit
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.last_error = None
+        self.last_time = None
+
+    def update(self, error, now):
+        if self.last_time is not None and now > self.last_time:
+            dt = now - self.last_time
+            derivative = (error - self.last_error) / dt
+            self.derivative = (self.smoothing * self.derivative +
+                               (1 - self.smoothing) * derivative)
+            self.integral += error * dt
+            if self.ki:
+                bound = self.limit / abs(self.ki)
+                self.integral = max(-bound, min(bound, self.integral))
+        self.last_error = error
+        self.last_time = now
+
+        output = self.kp * error + self.ki * self.integral + self.kd * self.derivative
+        return int(round(max(-self.limit, min(self.limit, output))))
+
+
+
 # Below is the finite state machine code.
 
 # AlignmentFSM is the main interface to a finite state machine that
@@ -59,13 +127,13 @@ class LookAround(State):
         self.controller.stop()
         self.move()
 
-        self.start_time = time.monotonic()
+        self.start_time = clock()
         print('LookAround: enter')
 
     def react(self, target):
         """Check if the timeout has been reached (terminate the FSM by
 returning None) or transition to LookAt"""
-        elapsed_time = time.monotonic() - self.start_time
+        elapsed_time = clock() - self.start_time
         if elapsed_time > timeout:
             print('LookAround: timeout')
             self.controller.stop()
@@ -73,7 +141,7 @@ returning None) or transition to LookAt"""
 
         if target:
             print('LookAround: target found')
-            return LookAt(self.controller)
+            return tracking_state(self.controller)
         else:
             return self
 
@@ -174,6 +242,42 @@ Aligned state, otherwise move.
 
         self.controller.set_left_right(value)
         self.controller.send()
+
+
+class Approach(State):
+    """Move the drone along all axes at once towards the goals, with a PID
+controller per rc axis"""
+    def __init__(self, controller):
+        self.controller = controller
+        self.controller.stop()
+        self.pids = {axis: PID(*gains, limit=pid_limit, smoothing=pid_smoothing)
+                     for axis, gains in pid_gains.items()}
+        print('Approach: enter')
+
+    def react(self, target):
+        """Transition to Aligned if every goal is met, otherwise move"""
+        if (target_centered(target.dx, target.dy) and
+            good_distance(target.distance) and
+            good_left_right(target.ratio)):
+            print('Approach: goals met')
+            return Aligned(self.controller)
+        else:
+            self.move(target)
+            return self
+
+    def move(self, target):
+        now = clock()
+        errors = {'yaw': target.dx,
+                  'up_down': target.dy,
+                  'forward_backward': target.distance - (distance_min + distance_max) / 2,
+                  'left_right': target.ratio - (ratio_min + ratio_max) / 2}
+        values = {axis: self.pids[axis].update(error, now) for axis, error in errors.items()}
+
+        self.controller.set_yaw(values['yaw'])
+        self.controller.set_up_down(values['up_down'])
+        self.controller.set_forward_backward(values['forward_backward'])
+        self.controller.set_left_right(values['left_right'])
+        self.controller.send()
             
             
         
@@ -196,7 +300,7 @@ terminate FSM, otherwise transition to LookAt."""
             return None
         else:
             print('Aligned: target not centered')
-            return LookAt(self.controller)
+            return tracking_state(self.controller)
     
         
 class AlignmentFSM:
@@ -212,10 +316,14 @@ It returns its internal state to every call of on_frame. The
 terminating condition is that its internal state will eventually be
 None.
 
+If profile, a profiles.ProfileWatcher, is given, a changed profile is
+applied at the start of on_frame, between two frames.
+
     """
-    def __init__(self, identifier, controller):
+    def __init__(self, identifier, controller, profile=None):
         self.identifier = identifier # used to find target
         self.controller = controller # used to control drone
+        self.profile = profile # parameters to reload when changed
 
         # start by looking around for the target
         self.state = LookAround(controller)
@@ -224,9 +332,16 @@ None.
         self.no_target_frame_count = 0
         self.no_target_frame_limit = no_target_frame_count
 
+        # the target found in the last frame, or None
+        self.target = None
+
     def on_frame(self, frame):
         """Modify the internal state based on the video frame"""
+        if self.profile is not None and self.profile.apply():
+            self.no_target_frame_limit = no_target_frame_count
+
         target = self.identifier.find_target(frame)
+        self.target = target
 
         if target: # target is found
             self.no_target_frame_count = 0 # reset counter
@@ -65,8 +65,26 @@ private:
   PyThreadState *state;
 };
 
-/* Fetch the pointer from string type (Python  2) or bytes type (Python 3) */
-void extract_data_ptr_from_buffer(py::object o, const ubyte* &data_in, ssize_t &len);
+/* Fetch the pointer from string type (Python 2), or in Python 3 from any object
+ * supporting the buffer protocol, e.g. bytes or a memoryview of a bytearray. The
+ * buffer is held until this object is destroyed, so the data stays valid while
+ * the GIL is released. */
+class InputBuffer
+{
+public:
+  explicit InputBuffer(const py::object &o);
+  ~InputBuffer();
+
+  InputBuffer(const InputBuffer &) = delete;
+  InputBuffer operator=(const InputBuffer &) = delete;
+
+  const ubyte *data;
+  ssize_t len;
+private:
+#if IS_PYTHON3
+  Py_buffer view;
+#endif
+};
 }
 
 
@@ -135,9 +153,9 @@ py::tuple PyH264Decoder::decode_frame_impl(const ubyte *data_in, ssize_t len, ss
 
 py::tuple PyH264Decoder::decode_frame(const py::object &py_data_in)
 {
-  ssize_t len;
-  const ubyte* data_in;
-  extract_data_ptr_from_buffer(py_data_in, data_in, len);
+  InputBuffer input(py_data_in);
+  ssize_t len = input.len;
+  const ubyte* data_in = input.data;
 
   ssize_t num_consumed = 0;
   bool is_frame_available = false;
@@ -149,9 +167,9 @@ py::tuple PyH264Decoder::decode_frame(const py::object &py_data_in)
 
 py::list PyH264Decoder::decode(const py::object &py_data_in)
 {
-  ssize_t len;
-  const ubyte* data_in;
-  extract_data_ptr_from_buffer(py_data_in, data_in, len);
+  InputBuffer input(py_data_in);
+  ssize_t len = input.len;
+  const ubyte* data_in = input.data;
   
   py::list out;
   
@@ -200,19 +218,28 @@ BOOST_PYTHON_MODULE(libh264decoder)
 
 
 namespace {
-  void extract_data_ptr_from_buffer(py::object o, const ubyte* &data_in, ssize_t &len)
+  InputBuffer::InputBuffer(const py::object &o)
   {
 #if IS_PYTHON3
-    auto raw_ptr = o.ptr();
-    if (!PyBytes_Check(raw_ptr))
-      throw std::invalid_argument("Input must be a byte array");
-    len = PyBytes_Size(raw_ptr);
-    data_in = (const ubyte*)(PyBytes_AsString(raw_ptr));
+    if (PyObject_GetBuffer(o.ptr(), &view, PyBUF_SIMPLE) != 0)
+    {
+      PyErr_Clear();
+      throw std::invalid_argument("Input must be a bytes-like object");
+    }
+    len = view.len;
+    data = (const ubyte*)(view.buf);
 #else
     if (!PyString_Check(o.ptr()))
       throw std::invalid_argument("Input must be a string");
     len = PyString_Size(o.ptr());
-    data_in = (const ubyte*)(PyString_AsString(o.ptr()));
+    data = (const ubyte*)(PyString_AsString(o.ptr()));
+#endif
+  }
+
+  InputBuffer::~InputBuffer()
+  {
+#if IS_PYTHON3
+    PyBuffer_Release(&view);
 #endif
   }
 }
@@ -1,12 +1,84 @@
 """Module to handle the lower-level networking"""
+import asyncio
+import collections
+import concurrent.futures
+import re
 import time
 import threading
-import socket
+
+# Seconds to wait for the response to a command. Queries and commands
+# such as keep alive, stop and emergency are answered straight away.
+# The drone only answers a move once it's finished, so the timeout of a
+# move is its distance at move_speed (cm/s, or the speed last set with
+# a speed command) or its angle at turn_rate (degrees/s), plus
+# move_margin. Any other command, e.g. takeoff or flip, gets
+# command_timeout.
+ack_timeout = 3
+command_timeout = 20
+move_margin = 5
+move_speed = 30
+turn_rate = 45
+immediate_commands = {'command', 'streamon', 'streamoff', 'stop', 'emergency', 'speed',
+                      'wifi', 'mon', 'moff'}
+moves = {'up', 'down', 'left', 'right', 'forward', 'back'}
+
+# Number of times to resend a command that got no response. Only
+# commands that are safe to repeat are retried, a retried move could
+# move the drone twice.
+retries = 2
+repeatable_commands = {'command', 'streamon', 'streamoff', 'stop', 'land', 'emergency'}
+
+# Number of recent commands kept in command_history, record flights with
+# a recorder.FlightRecorder to keep them all
+history_length = 1000
+
+def is_query(command):
+    """Queries ask for a value and end with a '?'"""
+    return command.endswith('?')
+
+def is_repeatable(command):
+    """Test if sending the command again can't do any harm"""
+    return is_query(command) or command in repeatable_commands
+
+def response_timeout(command, speed=None):
+    """Seconds to wait for the response to command, see ack_timeout. speed
+is the speed (cm/s) last set, if any."""
+    name, *args = command.split() or ['']
+    if is_query(command) or name in immediate_commands:
+        return ack_timeout
+    try:
+        values = [abs(float(arg)) for arg in args]
+        if name in moves:
+            return values[0] / (speed or move_speed) + move_margin
+        if name in ('cw', 'ccw'):
+            return values[0] / turn_rate + move_margin
+        if name == 'go':
+            return sum(x**2 for x in values[:3])**0.5 / values[3] + move_margin
+        if name == 'curve':
+            # the arc is no longer than the path through the mid point
+            x1, y1, z1, x2, y2, z2, curve_speed = values[:7]
+            length = (x1**2 + y1**2 + z1**2)**0.5 + ((x2 - x1)**2 + (y2 - y1)**2 + (z2 - z1)**2)**0.5
+            return length / curve_speed + move_margin
+    except (ValueError, IndexError, ZeroDivisionError):
+        return ack_timeout # the drone rejects it straight away
+    return command_timeout
+
+def parse_response(command, response):
+    """Convert the response to a query into a number, e.g. 'battery?' ->
+'87' -> 87 or 'height?' -> '10dm' -> 10. Other responses are returned
+unchanged."""
+    if not is_query(command):
+        return response
+    match = re.fullmatch(r'(-?\d+(\.\d+)?)[a-zA-Z]*', response.strip())
+    if match is None:
+        return response
+    number = match.group(1)
+    return float(number) if match.group(2) else int(number)
 
 class NoNetwork:
     """Provides a dummy network object that prints the commands sent and received"""
     def __init__(self):
-        self.command_history = []
+        self.command_history = collections.deque(maxlen=history_length)
 
     def close(self):
         pass
@@ -17,50 +89,202 @@ class NoNetwork:
 
     def recv(self):
         print('Recv: ok')
+        return 'ok'
 
     def sendrecv(self, command):
         self.send(command)
-        self.recv()
+        return self.recv()
+
+    def submit(self, command):
+        """Send command and return a future of its response"""
+        future = concurrent.futures.Future()
+        future.set_result(self.sendrecv(command))
+        return future
+
+
+class CommandProtocol(asyncio.DatagramProtocol):
+    """Sends text commands to drones and matches their responses to the
+commands waiting for them. A drone answers commands in the order it
+receives them, so each response from an address completes the oldest
+command in flight to that address.
+
+    """
+    def __init__(self):
+        self.transport = None
+        self.in_flight = collections.defaultdict(collections.deque)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        response = data.decode('utf-8', errors='replace').strip()
+        in_flight = self.in_flight[address]
+        if in_flight:
+            in_flight.popleft().set_result(response)
+        else:
+            print('Recv (unexpected) from {}: {}'.format(address[0], response))
+
+    def error_received(self, exc):
+        print('Caught exception in command protocol: {}'.format(exc))
+
+    def send(self, command, address):
+        """Send command without expecting a response"""
+        self.transport.sendto(command.encode('utf-8'), address)
+
+    def expect(self, address):
+        """Return a future for the next response from address"""
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[address].append(future)
+        return future
+
+    def forget(self, address, future):
+        """Stop waiting for the response of a command that timed out"""
+        try:
+            self.in_flight[address].remove(future)
+        except ValueError:
+            pass
+
+
+class CommandClient:
+    """Owns the command socket and runs an asyncio event loop for it in a
+background thread. Commands to each drone are queued so only one is in
+flight at a time, and each is given a timeout and, if it's safe to
+repeat, retried when no response arrives.
+
+Use submit() from ordinary code, it returns a concurrent.futures.Future
+of the response. The attribute latencies holds the round-trip time (s)
+of every answered command per address.
+
+An emergency is sent at once, without waiting for the commands queued
+before it, and then queued for its response like any other command.
+
+    """
+    def __init__(self, port=8889):
+        self.locks = {}
+        self.speeds = {} # speed (cm/s) last set on each address
+        self.latencies = collections.defaultdict(list)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.protocol = self.run(self.open(port)).result()
+
+    def run(self, coroutine):
+        """Schedule a coroutine on the event loop and return a future of its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def open(self, port):
+        _, protocol = await self.loop.create_datagram_endpoint(CommandProtocol,
+                                                               local_addr=('0.0.0.0', port))
+        return protocol
+
+    async def command(self, command, address):
+        """Send command to address and return its response"""
+        if address not in self.locks:
+            self.locks[address] = asyncio.Lock()
+        timeout = response_timeout(command, self.speeds.get(address))
+        attempts = 1 + (retries if is_repeatable(command) else 0)
+        if command == 'emergency':
+            # stop the motors now, not after the command in flight
+            self.protocol.send(command, address)
+
+        async with self.locks[address]:
+            for attempt in range(attempts):
+                future = self.protocol.expect(address)
+                start = time.monotonic()
+                self.protocol.send(command, address)
+                try:
+                    response = await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    self.protocol.forget(address, future)
+                    print('Timeout: {}'.format(command))
+                    continue
+                self.latencies[address].append(time.monotonic() - start)
+                if command.startswith('speed ') and response == 'ok':
+                    self.speeds[address] = float(command.split()[1])
+                return response
+
+        msg = 'Error in {}: no response after {} attempt(s)'
+        raise RuntimeError(msg.format(command, attempts))
+
+    def submit(self, command, address):
+        """Send command to address, return a future of its response"""
+        return self.run(self.command(command, address))
+
+    def send(self, command, address):
+        """Send command to address without waiting for a response"""
+        self.loop.call_soon_threadsafe(self.protocol.send, command, address)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.protocol.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
 
 class Network:
-    """Opens a socket connection to the drone"""
-    def __init__(self, ip='192.168.10.1', port=8889):
+    """Opens a socket connection to the drone. The socket is owned by a
+CommandClient, so responses always reach the command that caused them
+even while the keep alive thread is sending commands too.
+
+Several Network objects, one per drone, can share a client (and so a
+single socket) by passing it as client. Commands and their responses
+are recorded to recorder, a recorder.FlightRecorder, if one is given.
+
+    """
+    def __init__(self, ip='192.168.10.1', port=8889, client=None, recorder=None):
         # socket settings for sending commands
         self.address = (ip, port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(('', port))
+        self.owns_client = client is None
+        self.client = CommandClient(port) if client is None else client
 
+        self.alive = True
         self.thread_keep_alive = threading.Thread(target=self.keep_alive)
         self.thread_keep_alive.daemon = True
         self.thread_keep_alive.start()
 
-        self.command_history = []
+        self.command_history = collections.deque(maxlen=history_length)
+        self.recorder = recorder
 
     def close(self):
-        self.socket.close()
+        self.alive = False
+        if self.owns_client:
+            self.client.close()
 
     def keep_alive(self):
         """Send 'command' every 5 seconds to keep the drone from becoming inactive"""
-        while True:
-            self.send('command')
+        while self.alive:
+            self.client.submit('command', self.address)
             time.sleep(5)
 
     def send(self, command):
-        """Send command through socket"""
-        ip, port = self.address
-        self.socket.sendto(command.encode('utf-8'), self.address)
+        """Send command through socket without waiting for a response"""
+        self.client.send(command, self.address)
         print('Send: {}'.format(command))
         self.command_history.append(command)
+        if self.recorder:
+            self.recorder.record('command', command)
 
-    def recv(self):
-        """Wait for a response from socket"""
-        response, _ = self.socket.recvfrom(1024)
-        print('Recv: {}'.format(response.decode('utf-8')))
+    def submit(self, command):
+        """Send command through socket and return a future of its response,
+parsed if command is a query"""
+        print('Send: {}'.format(command))
+        self.command_history.append(command)
+        if self.recorder:
+            self.recorder.record('command', command)
+
+        future = concurrent.futures.Future()
+        def done(sent):
+            if sent.exception() is not None:
+                if self.recorder:
+                    self.recorder.record('response', '{}\nerror: {}'.format(command, sent.exception()))
+                future.set_exception(sent.exception())
+            else:
+                response = sent.result()
+                print('Recv: {}'.format(response))
+                if self.recorder:
+                    self.recorder.record('response', '{}\n{}'.format(command, response))
+                future.set_result(parse_response(command, response))
+        self.client.submit(command, self.address).add_done_callback(done)
+        return future
             
     def sendrecv(self, command):
-        """Send command through socket, wait for a response"""
-        self.send(command)
-        self.recv()
-
-
+        """Send command through socket, wait for a response and return it"""
+        return self.submit(command).result()
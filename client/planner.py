@@ -1,5 +1,7 @@
 """Module that provides planning tools to predict the drone flight path"""
 import functools
+import concurrent.futures
+import numpy as np
 from numpy import array, pi, sin, cos, arctan2
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D, proj3d
@@ -22,17 +24,115 @@ def update_path(func):
         self.update_path()
     return wrapper
 
+# Opcodes of the commands that move the drone, used by the batch
+# planner, and the unit movement of each in the drone's own frame
+# (right, forward, up). cw and ccw turn instead and go gives its own
+# movement.
+opcodes = {'takeoff': 0, 'up': 1, 'down': 2, 'left': 3, 'right': 4,
+           'forward': 5, 'back': 6, 'cw': 7, 'ccw': 8, 'go': 9}
+unit_moves = np.array([(0, 0, 1), (0, 0, 1), (0, 0, -1), (-1, 0, 0), (1, 0, 0),
+                       (0, 1, 0), (0, -1, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0)],
+                      dtype=float)
+takeoff_height = 50
+
+# In headless mode planners don't display their path when stopped but
+# are added to the list completed, e.g. to validate mission scripts
+headless = False
+completed = []
+
+def parse_commands(commands):
+    """Parse a list of commands into an array of opcodes and an (N, 4)
+array of their arguments, padded with zeros. Commands that don't move
+the drone are skipped."""
+    ops = []
+    args = []
+    for command in commands:
+        name, *values = command.split()
+        if name in opcodes:
+            ops.append(opcodes[name])
+            args.append([float(value) for value in values[:4]] + [0.0] * (4 - len(values[:4])))
+    return np.array(ops, dtype=np.int8), np.array(args, dtype=float).reshape((-1, 4))
+
+def compute_poses(ops, args):
+    """Compute the flight path of a batch of parsed commands at once.
+Headings are the cumulative sum of the turns, positions the cumulative
+sum of each command's movement rotated by the heading. Returns (N+1, 3)
+arrays of positions and directions, the first row being the start."""
+    distance = args[:, 0]
+
+    # heading (radians from the x axis) after each command
+    turns = np.where(ops == opcodes['ccw'], distance, 0.0)
+    turns -= np.where(ops == opcodes['cw'], distance, 0.0)
+    heading = pi/2 + np.cumsum(np.radians(turns))
+
+    # movement of each command in the drone's frame
+    moves = unit_moves[ops] * distance[:, None]
+    moves[ops == opcodes['takeoff']] = (0, 0, takeoff_height)
+    is_go = ops == opcodes['go']
+    moves[is_go] = args[is_go, :3]
+
+    # rotate the movements into the world frame, the drone faces along
+    # the y axis at the start
+    c = np.cos(heading - pi/2)
+    s = np.sin(heading - pi/2)
+    steps = np.column_stack((moves[:, 0] * c - moves[:, 1] * s,
+                             moves[:, 0] * s + moves[:, 1] * c,
+                             moves[:, 2]))
+
+    positions = np.zeros((len(ops) + 1, 3))
+    np.cumsum(steps, axis=0, out=positions[1:])
+    directions = np.zeros((len(ops) + 1, 3))
+    directions[0] = (0, 1, 0)
+    directions[1:, 0] = np.cos(heading)
+    directions[1:, 1] = np.sin(heading)
+    return positions, directions
+
+class PathBuffer:
+    """Growable array of 3D points. Space is preallocated and doubled when
+full, so appending a point takes constant time on average."""
+    def __init__(self, capacity=256):
+        self.data = np.zeros((capacity, 3))
+        self.size = 0
+
+    def append(self, point):
+        if self.size == len(self.data):
+            self.data = np.concatenate((self.data, np.zeros_like(self.data)))
+        self.data[self.size] = point
+        self.size += 1
+
+    def array(self):
+        """View of the points appended so far"""
+        return self.data[:self.size]
+
 class Planner:
     """Parses the commands that are sent to it, constructs a flight path,
-and then displays it"""
-    def __init__(self):
+and then displays it. If display is False, or the module is in headless
+mode, the path is computed but not displayed.
+
+In incremental mode each command advances the path as it is sent, so
+pose() and bounding_box() can be asked at any time. With live set
+(implies incremental) the path is also plotted as it grows.
+
+The attribute error holds the exception that cut the mission short, if
+any.
+
+    """
+    def __init__(self, display=True, incremental=False, live=False):
+        self.display = display
+        self.incremental = incremental or live
+        self.live_plot = LivePlot() if live else None
+        self.error = None
         self.command_history = []
 
         self.direction = array((0, 1, 0), dtype=float)
         self.position = array((0, 0, 0), dtype=float)
-        self.directions = []
-        self.positions = []
+        self.direction_buffer = PathBuffer()
+        self.position_buffer = PathBuffer()
+        self.lower = self.position.copy()
+        self.upper = self.position.copy()
         self.update_path()
+        self.directions = self.direction_buffer.array()
+        self.positions = self.position_buffer.array()
 
         self.commands = {
             'takeoff': self.takeoff,
@@ -53,8 +153,12 @@ and then displays it"""
         pass
 
     def send(self, command):
-        """Adds command to the history"""
+        """Adds command to the history, and to the path in incremental mode"""
         self.command_history.append(command)
+        if self.incremental:
+            self.parse_command(command)
+            if self.live_plot is not None:
+                self.live_plot.update(self.position_buffer.array())
 
     def recv(self):
         """Dummy interface for Network class"""
@@ -64,29 +168,55 @@ and then displays it"""
         self.send(command)
         self.recv()
 
+    def submit(self, command):
+        """Dummy interface for Network class"""
+        future = concurrent.futures.Future()
+        future.set_result(self.sendrecv(command))
+        return future
+
     def stop(self):
         """Fakes interface for Video class, but actually computes the path and
 displays the results
 
         """
-        self.compute_path()
-        self.display_path()
+        if self.incremental:
+            self.directions = self.direction_buffer.array()
+            self.positions = self.position_buffer.array()
+        else:
+            self.compute_path()
+        if headless:
+            completed.append(self)
+        elif self.display:
+            if self.live_plot is not None:
+                # LivePlot turned interactive mode on, let plt.show() block
+                plt.ioff()
+            self.display_path()
 
     def compute_path(self):
-        """Parse each of the commands in the history"""
-        for command in self.command_history:
-            self.parse_command(command)
+        """Compute the path of the whole command history in one batch"""
+        self.positions, self.directions = compute_poses(*parse_commands(self.command_history))
+        self.position = self.positions[-1].copy()
+        self.direction = self.directions[-1].copy()
+        self.lower = self.positions.min(axis=0)
+        self.upper = self.positions.max(axis=0)
 
     def parse_command(self, command):
         """Parse each command by dispatching to the correct function"""
         command, *args = command.split()
-        args = [int(arg) for arg in args]
         if command in self.commands:
+            args = [int(arg) for arg in args]
             self.commands[command](*args)
 
-    @update_path
+    def pose(self):
+        """Return the current (position, direction) of the drone"""
+        return self.position.copy(), self.direction.copy()
+
+    def bounding_box(self):
+        """Return the (lower, upper) corners of the box containing the path so far"""
+        return self.lower.copy(), self.upper.copy()
+
     def takeoff(self):
-        self.up(50)
+        self.up(takeoff_height)
 
     @update_path
     def up(self, distance):
@@ -161,11 +291,47 @@ displays the results
         plt.show()
         
     def update_path(self):
-        self.directions.append(self.direction.copy())
-        self.positions.append(self.position.copy())
+        self.direction_buffer.append(self.direction)
+        self.position_buffer.append(self.position)
+        np.minimum(self.lower, self.position, out=self.lower)
+        np.maximum(self.upper, self.position, out=self.upper)
                 
 
 
+class LivePlot:
+    """Plots a path while it's being planned. The axes are fixed to +/-
+extent (cm) so that each update only draws the segments added since
+the last one on top of the saved background (blitting) rather than
+redrawing the whole figure."""
+    def __init__(self, extent=500):
+        plt.ion()
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(projection='3d')
+        self.ax.set_xlabel('x')
+        self.ax.set_ylabel('y')
+        self.ax.set_zlabel('z')
+        self.ax.set_xlim(-extent, extent)
+        self.ax.set_ylim(-extent, extent)
+        self.ax.set_zlim(0, 2*extent)
+        plt.show(block=False)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.drawn = 1 # number of points already plotted
+
+    def update(self, positions):
+        """Draw the new segments of the path"""
+        if len(positions) <= self.drawn:
+            return
+        xs, ys, zs = positions[self.drawn-1:].T
+        line, = self.ax.plot(xs, ys, zs, color='C0', animated=True)
+        self.fig.canvas.restore_region(self.background)
+        self.ax.draw_artist(line)
+        self.fig.canvas.blit(self.fig.bbox)
+        self.fig.canvas.flush_events()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.drawn = len(positions)
+
+
 class Arrow3D(FancyArrowPatch):
     def __init__(self, xs, ys, zs, *args, **kwargs):
         FancyArrowPatch.__init__(self, (0,0), (0,0), *args, **kwargs)
@@ -0,0 +1,146 @@
+"""Module for parameter profiles that can be changed while flying.
+
+A profile is a JSON file of color thresholds (see recognition.thresholds)
+and FSM parameters (module globals of fsm.py), e.g.
+
+    {"thresholds": {"fuschia": [[136, 100, 36], [177, 255, 255]]},
+     "fsm": {"radius_centered": 40, "distance_max": 1.1}}
+
+Either part may be left out, as may any color or parameter. A
+ProfileWatcher checks the file's modification time in a background
+thread and loads it when it changes. The values are only swapped in by
+apply(), which AlignmentFSM.on_frame calls before each frame, so a
+frame is never processed with half of a profile.
+
+USAGE: python profiles.py venue.json    (writes the current values)
+"""
+import argparse
+import json
+import os
+import threading
+import recognition
+import fsm
+
+# fsm globals a profile may set
+fsm_parameters = ('no_target_frame_count', 'timeout', 'radius_centered',
+                  'distance_min', 'distance_max', 'ratio_min', 'ratio_max',
+                  'control_mode', 'pid_gains', 'pid_limit', 'pid_smoothing')
+
+def parse_profile(profile):
+    """Check a profile and convert it to the types the modules use.
+Returns (thresholds, fsm parameters), raises RuntimeError if invalid."""
+    if not isinstance(profile, dict) or not isinstance(profile.get('fsm', {}), dict):
+        raise RuntimeError('Invalid profile: must be {"thresholds": {...}, "fsm": {...}}')
+    unknown = set(profile) - {'thresholds', 'fsm'}
+    unknown |= set(profile.get('fsm', {})) - set(fsm_parameters)
+    if unknown:
+        raise RuntimeError('Unknown profile entries: {}'.format(', '.join(sorted(unknown))))
+    try:
+        thresholds = recognition.parse_thresholds(profile.get('thresholds', {}))
+        parameters = {}
+        for name, value in profile.get('fsm', {}).items():
+            if name == 'control_mode':
+                if value not in ('bang_bang', 'pid'):
+                    raise ValueError('control_mode must be bang_bang or pid')
+            elif name == 'pid_gains':
+                value = {axis: tuple(map(float, value[axis])) for axis in fsm.pid_gains}
+            elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError('{} must be a number'.format(name))
+            parameters[name] = value
+    except (TypeError, ValueError, KeyError) as err:
+        raise RuntimeError('Invalid profile value: {}'.format(err))
+    return thresholds, parameters
+
+def current_profile():
+    """The profile of the values in use"""
+    return {'thresholds': {color: [list(bound) for bound in threshold]
+                           for color, threshold in recognition.thresholds.items()},
+            'fsm': {name: getattr(fsm, name) for name in fsm_parameters}}
+
+
+class ProfileWatcher:
+    """Watches a profile file, polling its modification time every
+interval seconds, and loads it whenever it changes. A profile that
+can't be read or is invalid is reported and ignored, the values in use
+are kept.
+
+Call apply() between frames to swap in the latest profile loaded. The
+thresholds dict is replaced as a whole and the FSM parameters are set
+before the next frame is processed. Parameters the FSM reads when
+entering a state, such as the PID gains, take effect from the next
+state.
+
+    """
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = None # loaded profile waiting for apply()
+        self.modified = None # (mtime, size) of the file last read
+        self.loads = 0 # number of profiles applied
+        self.poll()
+
+        self.stopped = threading.Event()
+        self.thread_watch = threading.Thread(target=self.watch)
+        self.thread_watch.daemon = True
+        self.thread_watch.start()
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        """Load the file if it changed since it was last read"""
+        try:
+            stat = os.stat(self.path)
+        except OSError as err:
+            if self.modified is not False:
+                print('Caught exception watching profile: {}'.format(err))
+            self.modified = False
+            return
+        modified = (stat.st_mtime_ns, stat.st_size)
+        if modified == self.modified:
+            return
+        self.modified = modified
+
+        try:
+            with open(self.path) as f:
+                profile = parse_profile(json.load(f))
+        except (OSError, ValueError, TypeError, AttributeError, RuntimeError) as err:
+            print('Error in profile {}: {}'.format(self.path, err))
+            return
+        with self.lock:
+            self.pending = profile
+
+    def apply(self):
+        """Swap in the latest profile loaded, if any. Returns True if the
+values changed."""
+        with self.lock:
+            profile, self.pending = self.pending, None
+        if profile is None:
+            return False
+
+        thresholds, parameters = profile
+        recognition.apply_thresholds(thresholds)
+        for name, value in parameters.items():
+            setattr(fsm, name, value)
+        self.loads += 1
+        print('Profile: loaded {}'.format(self.path))
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+
+def get_arguments():
+    ap = argparse.ArgumentParser(description='Write the parameters in use as a profile')
+    ap.add_argument('output', help='Profile to write, e.g. venue.json')
+    return ap.parse_args()
+
+def main():
+    args = get_arguments()
+    with open(args.output, 'w') as f:
+        json.dump(current_profile(), f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
 """Module for processing the video stream from the drone and reacting
 to objects within it"""
+import json
+import os
+import time
+import concurrent.futures
+import numpy as np
 import cv2
 
 # HSV thresholds for colors used in testing
@@ -17,20 +22,133 @@ thresholds = {'green': ((15, 193, 128), (39, 244, 207)),
               'blue-webcam': ((110, 72, 34), (130, 255, 255)),
 }
 
-def threshold_image(image, color):
-    """Select only the objects in the image that match the given color"""
+def parse_thresholds(entries):
+    """Convert the {color: [lower, upper]} thresholds of a JSON profile to
+the (lower, upper) tuples of thresholds. Raises ValueError if invalid."""
+    loaded = {}
+    try:
+        for color, (lower, upper) in entries.items():
+            lower, upper = tuple(map(int, lower)), tuple(map(int, upper))
+            if len(lower) != 3 or len(upper) != 3:
+                raise ValueError('bounds of {} must be 3 HSV values'.format(color))
+            loaded[color] = (lower, upper)
+    except (TypeError, AttributeError) as err:
+        raise ValueError('thresholds must be {{color: [lower, upper]}}: {}'.format(err))
+    return loaded
+
+def apply_thresholds(loaded):
+    """Swap in thresholds updated with loaded. The dict is replaced as a
+whole so a frame is never thresholded with half of them."""
+    global thresholds
+    thresholds = {**thresholds, **loaded}
+
+def load_thresholds(path):
+    """Update thresholds with the colors of a JSON profile, e.g. written by
+tune_thresholds.py, and return the thresholds loaded"""
+    with open(path) as f:
+        profile = json.load(f)
+    loaded = parse_thresholds(profile['thresholds'])
+    apply_thresholds(loaded)
+    return loaded
+
+def save_thresholds(path, colors=None):
+    """Save the thresholds of colors (all by default) to a JSON profile,
+keeping anything else an existing profile holds"""
+    profile = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profile = json.load(f)
+    colors = thresholds if colors is None else colors
+    profile['thresholds'] = {color: [list(bound) for bound in thresholds[color]]
+                             for color in colors}
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+
+def preprocess(image):
+    """Blur the image and convert it to HSV, ready for thresholding"""
     # blur image, reduce noise, keep edges
     blur = cv2.bilateralFilter(image, 11, 17, 17)
+    return cv2.cvtColor(blur, cv2.COLOR_BGR2HSV)
 
-    # convert to HSV and threshold image
-    hsv = cv2.cvtColor(blur, cv2.COLOR_BGR2HSV)
-    thresh = cv2.inRange(hsv, *thresholds[color])
-
-    # remove any small blobs
+def remove_blobs(thresh):
+    """Remove any small blobs from a thresholded image"""
     thresh = cv2.erode(thresh, None, iterations=1)
     thresh = cv2.dilate(thresh, None, iterations=1)
     return thresh
 
+def threshold_hsv(hsv, color):
+    """Select only the objects in an HSV image that match the given color"""
+    thresh = cv2.inRange(hsv, *thresholds[color])
+    return remove_blobs(thresh)
+
+class ColorClassifier:
+    """Labels every pixel of an HSV image with all of a set of colors in
+one pass, instead of calling cv2.inRange once per color.
+
+For each channel there is a 256 entry lookup table holding a bitmask
+of the colors whose threshold range contains that value. One cv2.LUT
+pass maps each pixel to the three bitmasks of its channels, and a
+color's bit survives ANDing them only if all three channels are in
+range. Up to 8 colors are supported.
+
+    """
+    def __init__(self, colors):
+        if len(colors) > 8:
+            raise ValueError('ColorClassifier supports at most 8 colors, not {}'.format(len(colors)))
+        self.colors = list(colors)
+        self.lut = np.zeros((1, 256, 3), dtype=np.uint8)
+        for bit, color in enumerate(self.colors):
+            lower, upper = thresholds[color]
+            for channel in range(3):
+                self.lut[0, lower[channel]:upper[channel] + 1, channel] |= 1 << bit
+
+    def classify(self, hsv):
+        """Return an image of the bitmask of the colors matching each pixel"""
+        bits = cv2.LUT(hsv, self.lut)
+        labels = np.bitwise_and(bits[:, :, 0], bits[:, :, 1])
+        np.bitwise_and(labels, bits[:, :, 2], out=labels)
+        return labels
+
+    def mask(self, labels, color):
+        """Select the pixels of a color from the labels made by classify(),
+like cv2.inRange does"""
+        bit = 1 << self.colors.index(color)
+        return cv2.compare(cv2.bitwise_and(labels, bit), 0, cv2.CMP_GT)
+
+# classifiers already built, keyed by their colors and thresholds
+classifiers = {}
+
+# One ColorClassifier pass costs about as much as cv2.inRange for 6 to
+# 8 colors, so only use it for that many colors
+classifier_min_colors = 6
+
+def color_classifier(colors):
+    """Return a ColorClassifier for the colors, reusing one built earlier
+unless the thresholds of the colors have changed"""
+    key = tuple((color, thresholds[color]) for color in colors)
+    if key not in classifiers:
+        classifiers[key] = ColorClassifier(colors)
+    return classifiers[key]
+
+def threshold_image(image, color):
+    """Select only the objects in the image that match the given color"""
+    return threshold_hsv(preprocess(image), color)
+
+def threshold_colors(image, colors):
+    """Select the objects in the image matching each of the given
+colors. The image is blurred and converted to HSV only once, which is
+the expensive part, and then thresholded for every color. Returns a
+dictionary of color -> thresholded image.
+
+    """
+    hsv = preprocess(image)
+    if len(colors) < classifier_min_colors:
+        return {color: threshold_hsv(hsv, color) for color in colors}
+
+    classifier = color_classifier(colors)
+    labels = classifier.classify(hsv)
+    return {color: remove_blobs(classifier.mask(labels, color)) for color in colors}
+
 def find_square(image, minimum_area=400):
     """Attempt to find a 4-sided polygon in the image with a minimum
 area. Return it if successful otherwise return None.
@@ -38,7 +156,7 @@ area. Return it if successful otherwise return None.
     """
     # find all possible contours in image
     contours = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = contours[1]
+    contours = contours[-2] # OpenCV 3 also returns the image first
 
     # sort the contours by area, largest to smallest
     for c in sorted(contours, key=cv2.contourArea, reverse=True):
@@ -54,7 +172,7 @@ area. Return it if successful otherwise return None.
 def contained_within(contour_larger, contour_smaller):
     """Test if contour_smaller is contained within contour_larger"""
     for (x,y) in contour_smaller[0]:
-        result = cv2.pointPolygonTest(contour_larger, (x,y), False)
+        result = cv2.pointPolygonTest(contour_larger, (float(x), float(y)), False)
         if result != 1:
             return False
     return True
@@ -87,6 +205,29 @@ def distance(contour):
     factor = 136.0
     return factor / avg # meters
 
+def offset_contour(contour, x, y):
+    """Shift a contour found in a region of an image by the region's
+top-left corner (x, y), giving its coordinates in the whole image"""
+    return contour + np.array((x, y), dtype=contour.dtype)
+
+def scale_contour(contour, factor):
+    """Scale the coordinates of a contour, e.g. to map a contour found in
+a downscaled image back to the full size image"""
+    return np.round(contour * factor).astype(contour.dtype)
+
+def padded_region(contour, padding, width, height):
+    """Bounding rectangle (x, y, w, h) of the contour, grown on every
+side by padding (a fraction of the rectangle's size) and clipped to an
+image of the given width and height"""
+    x, y, w, h = cv2.boundingRect(contour)
+    pad_x = int(w * padding)
+    pad_y = int(h * padding)
+    x0 = max(x - pad_x, 0)
+    y0 = max(y - pad_y, 0)
+    x1 = min(x + w + pad_x, width)
+    y1 = min(y + h + pad_y, height)
+    return x0, y0, x1 - x0, y1 - y0
+
 def centroid(contour):
     """Return the centroid of the contour"""
     M = cv2.moments(contour)
@@ -115,6 +256,57 @@ def find_square_contour(frame, color):
     contour = find_square(thresh)
     return contour
 
+def find_square_hsv(hsv, color, minimum_area=400):
+    """Find a square of the given color in an HSV image. Returns its
+contour (or None) and the seconds spent in the threshold and
+find_square stages, for timing them in a worker thread"""
+    start = time.perf_counter()
+    thresh = threshold_hsv(hsv, color)
+    thresholded = time.perf_counter()
+    contour = find_square(thresh, minimum_area)
+    return contour, {'threshold': thresholded - start,
+                     'find_square': time.perf_counter() - thresholded}
+
+def find_square_contours(frame, colors):
+    """Find a square for each of the colors within the frame, sharing
+the blur and HSV conversion between them. Returns a dictionary of
+color -> contour (or None if no square was found).
+
+    """
+    return {color: find_square(thresh)
+            for color, thresh in threshold_colors(frame, colors).items()}
+
+class StageTimer:
+    """Measures the time spent in each stage of processing a frame. Call
+lap() with the name of a stage when it finishes; the elapsed seconds
+since the previous lap are added to timings[stage].
+
+    """
+    def __init__(self):
+        self.timings = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        """Record the time since the last lap against stage"""
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def lap_split(self, seconds):
+        """Record the time since the last lap against stages that ran in
+parallel, split in proportion to the seconds {stage: seconds} each
+stage took summed over the threads"""
+        now = time.perf_counter()
+        total = sum(seconds.values())
+        for stage, spent in seconds.items():
+            share = spent / total if total > 0 else 1 / len(seconds)
+            self.timings[stage] = self.timings.get(stage, 0.0) + (now - self.last) * share
+        self.last = now
+
+    def total(self):
+        """Total time spent in all stages (s)"""
+        return sum(self.timings.values())
+
 class TargetData:
     """Stores the relevant target data
 contour : an opencv contour object
@@ -122,39 +314,166 @@ dx : target displacement in width (pixels)
 dy : target displacement in height (pixels)
 distance : calculated distance to target (m)
 ratio : ratio of left- and right-vertical edges of target
+scale : scale of the image the contour was measured in relative to the
+        frame (1 = full resolution)
+coarse_scale : scale of the downscaled image the target was first found
+               in (1 = no downscaling)
 """
-    def __init__(self, contour, dx, dy, distance, ratio):
+    def __init__(self, contour, dx, dy, distance, ratio, scale=1.0, coarse_scale=1.0):
         self.contour = contour
         self.dx = dx
         self.dy = dy
         self.distance = distance
         self.ratio = ratio
+        self.scale = scale
+        self.coarse_scale = coarse_scale
     
 class TargetIdentifier:
     """Given colors for two concentric squares squares, method
 find_target() generates a TargetData object if a target is found in
 the video frame, otherwise None.
 
+After each call to find_target() the attribute timings holds the time
+(s) spent in each stage for that frame: resize (if downscaling),
+preprocess, threshold, find_square, containment and draw.
+
+With scale below 1 (e.g. 0.5 or 0.25) the target is first looked for
+in a copy of the frame downscaled by that factor, which is several
+times cheaper. A region around the candidate found there is then
+searched again at full resolution so that distance() and
+vertical_line_ratio() stay accurate. If that fails the coarse contour
+is used, scaled up.
+
+With workers above 0 the thresholding, morphology and contour search
+for each color run in parallel on a persistent pool of that many
+threads (OpenCV releases the GIL while it works). The time of that
+parallel section is split between threshold and find_square in
+proportion to the time the threads spent in each, so the stages are
+the same in both modes. Call close() when done to stop the threads.
+
+With tracking enabled, once a target is found only a region around its
+last contour is searched (grown by roi_padding times its size on each
+side). The search falls back to the whole frame after max_misses
+consecutive frames without a target. The attribute region holds the
+(x, y, w, h) searched in the last frame.
+
     """
-    def __init__(self, color_outer, color_inner):
+    def __init__(self, color_outer, color_inner, tracking=False,
+                 roi_padding=0.5, max_misses=5, scale=1.0, minimum_area=400,
+                 workers=0):
         self.color_outer = color_outer
         self.color_inner = color_inner
+        self.minimum_area = minimum_area
+        self.timings = {}
+
+        self.executor = None
+        if workers > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        self.scale = scale
+        self.refine_padding = 0.2
+
+        self.tracking = tracking
+        self.roi_padding = roi_padding
+        self.max_misses = max_misses
+        self.last_contour = None
+        self.misses = 0
+        self.region = None
+
+    def search_region(self, frame):
+        """Return the region (x, y, w, h) of the frame to search for the target"""
+        height, width = frame.shape[:2]
+        if not self.tracking or self.last_contour is None:
+            return 0, 0, width, height
+        return padded_region(self.last_contour, self.roi_padding, width, height)
+
+    def update_tracking(self, target_data):
+        """Remember where the target was found, or count a miss and forget
+the target's location after too many misses"""
+        if target_data is not None:
+            self.last_contour = target_data.contour
+            self.misses = 0
+        elif self.last_contour is not None:
+            self.misses += 1
+            if self.misses >= self.max_misses:
+                self.last_contour = None
+                self.misses = 0
+
+    def detect(self, image, timer, minimum_area):
+        """Find the outer and inner squares of the target in the image.
+Return the pair of contours, or None if there is no target."""
+        hsv = preprocess(image)
+        timer.lap('preprocess')
+        if self.executor is not None:
+            futures = [self.executor.submit(find_square_hsv, hsv, color, minimum_area)
+                       for color in (self.color_outer, self.color_inner)]
+            (contour_outer, outer), (contour_inner, inner) = [future.result() for future in futures]
+            timer.lap_split({stage: outer[stage] + inner[stage] for stage in outer})
+        else:
+            thresh_outer = threshold_hsv(hsv, self.color_outer)
+            thresh_inner = threshold_hsv(hsv, self.color_inner)
+            timer.lap('threshold')
+            contour_outer = find_square(thresh_outer, minimum_area)
+            contour_inner = find_square(thresh_inner, minimum_area)
+            timer.lap('find_square')
+        found = (contour_outer is not None and
+                 contour_inner is not None and
+                 contained_within(contour_outer, contour_inner))
+        timer.lap('containment')
+        return (contour_outer, contour_inner) if found else None
+
+    def find_contour(self, frame, timer):
+        """Find the outer contour of the target in the search region of the
+frame, coarse to fine if downscaling. Return the contour in frame
+coordinates and the scale it was measured at, or (None, None)."""
+        x, y, w, h = self.region = self.search_region(frame)
+        if self.scale >= 1:
+            contours = self.detect(frame[y:y+h, x:x+w], timer, self.minimum_area)
+            if contours is None:
+                return None, None
+            return offset_contour(contours[0], x, y), 1.0
+
+        coarse = cv2.resize(frame[y:y+h, x:x+w], None, fx=self.scale, fy=self.scale,
+                            interpolation=cv2.INTER_AREA)
+        timer.lap('resize')
+        contours = self.detect(coarse, timer, self.minimum_area * self.scale**2)
+        if contours is None:
+            return None, None
+        candidate = offset_contour(scale_contour(contours[0], 1 / self.scale), x, y)
+
+        # refine the candidate at full resolution
+        height, width = frame.shape[:2]
+        x, y, w, h = padded_region(candidate, self.refine_padding, width, height)
+        contours = self.detect(frame[y:y+h, x:x+w], timer, self.minimum_area)
+        if contours is None:
+            return candidate, self.scale
+        return offset_contour(contours[0], x, y), 1.0
 
     def find_target(self, frame):
         """Find target in video frame and return TargetData, otherwise return None"""
-        contour_outer = find_square_contour(frame, self.color_outer)
-        contour_inner = find_square_contour(frame, self.color_inner)
-        if (contour_outer is not None and
-            contour_inner is not None and
-            contained_within(contour_outer, contour_inner)):
-            dx, dy = centroid_displacement(contour_outer, frame)
-            dist = distance(contour_outer)
-            ratio = vertical_line_ratio(contour_outer)
-            target_data = TargetData(contour_outer, dx, dy, dist, ratio)
+        timer = StageTimer()
+        contour, scale = self.find_contour(frame, timer)
+
+        target_data = None
+        if contour is not None:
+            dx, dy = centroid_displacement(contour, frame)
+            dist = distance(contour)
+            ratio = vertical_line_ratio(contour)
+            coarse_scale = min(self.scale, 1.0)
+            target_data = TargetData(contour, dx, dy, dist, ratio, scale, coarse_scale)
             self.draw(frame, target_data)
-            return target_data
-        else:
-            return None
+        timer.lap('draw')
+
+        if self.tracking:
+            self.update_tracking(target_data)
+        self.timings = timer.timings
+        return target_data
+
+    def close(self):
+        """Stop the worker threads, if any"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
     def draw(self, frame, target_data):
         """Draw target data onto the video frame"""
@@ -0,0 +1,228 @@
+"""Module for recording flights to a log for post-flight analysis.
+
+A FlightRecorder appends timestamped records to a binary log: the
+commands sent to the drone and their responses, the telemetry it
+broadcasts, the raw H.264 access units of its video stream and the
+results of target recognition. Recording only queues the record, a
+background thread writes them to disk, so the control loop never waits
+on the disk.
+
+A log file starts with a header (magic, wall clock time and
+time.monotonic when it was opened), followed by chunks. Each chunk is a
+header (b'CHNK', number of records, bytes) followed by its records, and
+each record is a header (kind, time.monotonic, bytes) followed by its
+payload:
+
+command   : the command text
+response  : the command text, a newline and the response text
+telemetry : the state packet, as received
+video     : an H.264 access unit, as received
+target    : JSON of the frame id, FSM state and the target measured
+
+When a file grows past max_file_size the log continues in the next
+file, flight.000.log, flight.001.log, ... for a log named flight.log.
+
+USAGE: python recorder.py flight.log --video flight.h264
+"""
+import argparse
+import collections
+import glob
+import os
+import struct
+import threading
+import time
+
+kinds = ('command', 'response', 'telemetry', 'video', 'target')
+kind_codes = {kind: code for code, kind in enumerate(kinds, 1)}
+
+magic = b'TELSIMLG'
+file_header = struct.Struct('<8sdd') # magic, time.time(), time.monotonic()
+chunk_header = struct.Struct('<4sII') # b'CHNK', records, bytes
+record_header = struct.Struct('<BdI') # kind, time.monotonic(), bytes
+
+def log_file(path, index):
+    """Name of the index-th file of a log, e.g. flight.log -> flight.002.log"""
+    root, ext = os.path.splitext(path)
+    return '{}.{:03d}{}'.format(root, index, ext)
+
+def log_files(path):
+    """Files of a log in order, or path itself if it's a single file"""
+    if os.path.isfile(path):
+        return [path]
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob('{}.[0-9][0-9][0-9]{}'.format(glob.escape(root), ext)))
+
+
+class FlightRecorder:
+    """Writes records to a log at path through a background thread.
+
+Records are queued in memory and written in chunks of about chunk_size
+bytes, or every flush_interval seconds. At most max_pending bytes are
+queued: if the disk can't keep up, further records are dropped (and
+counted) rather than blocking or growing without bound. The attribute
+stats counts the records and bytes written, the records dropped and
+the files opened.
+
+    """
+    def __init__(self, path, max_file_size=256 << 20, max_pending=32 << 20,
+                 chunk_size=1 << 20, flush_interval=0.5):
+        self.path = path
+        self.max_file_size = max_file_size
+        self.max_pending = max_pending
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.condition = threading.Condition()
+        self.stats = {'records': 0, 'bytes': 0, 'dropped': 0, 'files': 0}
+        self.file = None
+
+        self.recording = True
+        self.thread_writer = threading.Thread(target=self.write_records)
+        self.thread_writer.daemon = True
+        self.thread_writer.start()
+
+    def record(self, kind, payload, timestamp=None):
+        """Queue a record of kind (one of kinds) with payload (str or a
+bytes-like object, which is copied). Returns False if it was dropped."""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        else:
+            payload = bytes(payload) # the caller may reuse its buffer
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        header = record_header.pack(kind_codes[kind], timestamp, len(payload))
+        size = len(header) + len(payload)
+
+        with self.condition:
+            if not self.recording or self.pending_bytes + size > self.max_pending:
+                self.stats['dropped'] += 1
+                return False
+            self.pending.append((header, payload))
+            self.pending_bytes += size
+            if self.pending_bytes >= self.chunk_size:
+                self.condition.notify()
+        return True
+
+    def write_records(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: (self.pending_bytes >= self.chunk_size or
+                                                 not self.recording),
+                                        self.flush_interval)
+                records, self.pending = self.pending, collections.deque()
+                self.pending_bytes = 0
+                recording = self.recording
+
+            # split the records into chunks of about chunk_size bytes
+            chunk = []
+            size = 0
+            for header, payload in records:
+                chunk.append((header, payload))
+                size += len(header) + len(payload)
+                if size >= self.chunk_size:
+                    self.write_chunk(chunk, size)
+                    chunk = []
+                    size = 0
+            if chunk:
+                self.write_chunk(chunk, size)
+            if not recording:
+                break
+
+    def write_chunk(self, records, size):
+        """Write the records as one chunk, opening the next file if the
+current one is full"""
+        parts = [chunk_header.pack(b'CHNK', len(records), size)]
+        for header, payload in records:
+            parts.append(header)
+            parts.append(payload)
+        try:
+            if self.file is None or self.file.tell() >= self.max_file_size:
+                self.open_next_file()
+            self.file.write(b''.join(parts))
+            self.file.flush()
+        except OSError as err:
+            print('Caught exception writing flight log: {}'.format(err))
+            with self.condition:
+                self.stats['dropped'] += len(records)
+            return
+        with self.condition:
+            self.stats['records'] += len(records)
+            self.stats['bytes'] += size
+
+    def open_next_file(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(log_file(self.path, self.stats['files']), 'wb')
+        self.file.write(file_header.pack(magic, time.time(), time.monotonic()))
+        self.stats['files'] += 1
+
+    def close(self):
+        """Write the queued records and close the log"""
+        with self.condition:
+            self.recording = False
+            self.condition.notify()
+        self.thread_writer.join()
+        if self.file is not None:
+            self.file.close()
+
+
+def read_log(path):
+    """Yield the (kind, timestamp, payload) records of a log in order. A
+chunk cut short, e.g. by a crash, ends its file."""
+    for name in log_files(path):
+        with open(name, 'rb') as f:
+            header = f.read(file_header.size)
+            if len(header) < file_header.size or header[:len(magic)] != magic:
+                raise RuntimeError('Not a flight log: {}'.format(name))
+            while True:
+                header = f.read(chunk_header.size)
+                if len(header) < chunk_header.size:
+                    break
+                tag, count, size = chunk_header.unpack(header)
+                data = f.read(size)
+                if tag != b'CHNK' or len(data) < size:
+                    break
+                view = memoryview(data)
+                offset = 0
+                for _ in range(count):
+                    code, timestamp, length = record_header.unpack_from(view, offset)
+                    offset += record_header.size
+                    yield kinds[code - 1], timestamp, bytes(view[offset:offset+length])
+                    offset += length
+
+def get_arguments():
+    ap = argparse.ArgumentParser(description='Summarise a flight log')
+    ap.add_argument('log', help='Flight log, e.g. flight.log for flight.000.log, ...')
+    ap.add_argument('--video', help='Extract the H.264 stream to this file')
+    ap.add_argument('--commands', action='store_true', help='Print the commands and responses')
+    return ap.parse_args()
+
+def main():
+    args = get_arguments()
+    counts = collections.Counter()
+    sizes = collections.Counter()
+    first = last = None
+    video = open(args.video, 'wb') if args.video else None
+    try:
+        for kind, timestamp, payload in read_log(args.log):
+            counts[kind] += 1
+            sizes[kind] += len(payload)
+            first = timestamp if first is None else first
+            last = timestamp
+            if kind == 'video' and video:
+                video.write(payload)
+            elif kind in ('command', 'response') and args.commands:
+                print('{:10.3f} {:8} {}'.format(timestamp - first, kind,
+                                                payload.decode('utf-8', errors='replace')))
+    finally:
+        if video:
+            video.close()
+
+    if first is not None:
+        print('{:.1f} s recorded'.format(last - first))
+    for kind in kinds:
+        print('{:10} {:8d} records {:12d} bytes'.format(kind, counts[kind], sizes[kind]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""Closed-loop simulation of target alignment, to tune the goals and
+bands of fsm.py without flying.
+
+Each simulated drone integrates a simple kinematic model of the rc
+command: the stick positions set body frame velocities, which the drone
+reaches with a first order lag. The target is the one synthetic.py
+renders, at the origin facing the drones which start a few meters in
+front of it. Every frame the pose of each drone is projected with
+synthetic.labels_for into the recognition.TargetData an ideal
+identifier would measure (optionally with noise, dropped detections and
+latency), and handed to its own fsm.AlignmentFSM through a
+controller.DroneController, exactly as Drone.align_to_target does.
+
+All episodes are stepped in lockstep so the projection is vectorized,
+which runs thousands of episodes in seconds. With frames=True the
+frames are rendered and a real recognition.TargetIdentifier is used
+instead, which is much slower but tests recognition in the loop.
+
+The report gives the success rate, the convergence time of the
+episodes that aligned, the number of oscillations (sign reversals of a
+stick) and a histogram of state transitions.
+
+USAGE: python simulator.py --episodes 1000 --ratio-min 0.9 --ratio-max 1.1
+"""
+import argparse
+import collections
+import contextlib
+import json
+import os
+import time
+import numpy as np
+import fsm
+import controller
+import recognition
+import synthetic
+
+# kinematic model of the drone
+max_speed = 1.0 # m/s at stick position 100
+max_yaw_rate = 100.0 # degrees/s at stick position 100
+response_time = 0.2 # s, time constant of reaching the commanded velocity
+
+
+class SimulatedDrone:
+    """Stands in for a Drone in a controller.DroneController. rc() sets
+the commanded velocity of one drone of the simulation and counts the
+sign reversals of each stick."""
+    def __init__(self, simulation, index):
+        self.simulation = simulation
+        self.index = index
+        self.last_sign = [0, 0, 0, 0]
+        self.oscillations = 0
+        self.commands = 0
+
+    def rc(self, left_right, forward_backward, up_down, yaw):
+        sticks = (left_right, forward_backward, up_down, yaw)
+        self.simulation.command[self.index] = sticks
+        self.commands += 1
+        for axis, value in enumerate(sticks):
+            sign = (value > 0) - (value < 0)
+            if sign:
+                if sign == -self.last_sign[axis]:
+                    self.oscillations += 1
+                self.last_sign[axis] = sign
+
+
+class SimulatedIdentifier:
+    """Stands in for a recognition.TargetIdentifier, returning the target
+the simulation measured for one drone this frame"""
+    def __init__(self, simulation, index):
+        self.simulation = simulation
+        self.index = index
+
+    def find_target(self, frame):
+        return self.simulation.targets[self.index]
+
+
+class Simulation:
+    """Lockstep simulation of drones aligning to the target.
+
+starts : (N, 4) initial poses x (m, right of the target), y (m, negative
+         in front of the target), z (m, above the target center) and
+         heading (degrees clockwise, 0 faces the target)
+rate : frames per second
+latency : frames between a pose and the target measured from it
+pixel_noise, distance_noise, ratio_noise : standard deviations of the
+         noise added to dx and dy, distance and ratio
+dropout : probability a visible target isn't detected in a frame
+frames : render frames and run a real TargetIdentifier on each
+    """
+    def __init__(self, starts, rate=30, latency=0, pixel_noise=0.0, distance_noise=0.0,
+                 ratio_noise=0.0, dropout=0.0, frames=False, shape=(720, 960), rng=None):
+        self.pose = np.array(starts, dtype=float).reshape(-1, 4)
+        self.velocity = np.zeros_like(self.pose)
+        self.command = np.zeros_like(self.pose)
+        self.rate = rate
+        self.dt = 1.0 / rate
+        self.time = 0.0
+        self.shape = shape
+        self.pixel_noise = pixel_noise
+        self.distance_noise = distance_noise
+        self.ratio_noise = ratio_noise
+        self.dropout = dropout
+        self.frames = frames
+        self.rng = np.random.default_rng() if rng is None else rng
+
+        count = len(self.pose)
+        self.drones = [SimulatedDrone(self, i) for i in range(count)]
+        self.controllers = [controller.DroneController(drone) for drone in self.drones]
+        if frames:
+            self.identifiers = [recognition.TargetIdentifier('fuschia', 'blue')
+                                for _ in range(count)]
+        else:
+            self.identifiers = [SimulatedIdentifier(self, i) for i in range(count)]
+        self.targets = [None] * count
+        self.measurements = collections.deque(maxlen=latency + 1)
+
+    def step(self):
+        """Advance the drones by one frame"""
+        speed = np.array([max_speed, max_speed, max_speed, max_yaw_rate]) / 100
+        self.velocity += (self.command * speed - self.velocity) * min(1.0, self.dt / response_time)
+
+        left_right, forward, up, yaw_rate = self.velocity.T
+        heading = np.radians(self.pose[:, 3])
+        self.pose[:, 0] += (left_right * np.cos(heading) + forward * np.sin(heading)) * self.dt
+        self.pose[:, 1] += (forward * np.cos(heading) - left_right * np.sin(heading)) * self.dt
+        self.pose[:, 2] += up * self.dt
+        self.pose[:, 3] = (self.pose[:, 3] + yaw_rate * self.dt + 180) % 360 - 180
+        self.time += self.dt
+
+    def camera_pose(self):
+        """Pose of the target relative to each drone's camera, as the
+(distance, yaw, offset_x, offset_y) synthetic.py expects"""
+        x, y, z, heading = self.pose.T
+        angle = np.radians(heading)
+        distance = -x * np.sin(angle) - y * np.cos(angle)
+        offset_x = -x * np.cos(angle) + y * np.sin(angle)
+        return distance, heading, offset_x, -z
+
+    def noise(self, sigma, count):
+        """Gaussian noise with standard deviation sigma, if any"""
+        return self.rng.normal(0, sigma, count) if sigma else 0.0
+
+    def measure(self, active):
+        """Measure the target each active drone sees, after the latency"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            labels = synthetic.labels_for(*self.camera_pose(), shape=self.shape)
+            corners, _ = synthetic.project(*self.camera_pose(), shape=self.shape)
+            contours = np.rint(corners).astype(np.int32)[:, :, None, :]
+        self.measurements.append((labels, contours))
+        labels, contours = self.measurements[0]
+
+        count = len(labels)
+        detected = labels['visible'] & (self.rng.random(count) >= self.dropout)
+        dx = labels['dx'] + self.noise(self.pixel_noise, count)
+        dy = labels['dy'] + self.noise(self.pixel_noise, count)
+        distance = labels['pixel_distance'] + self.noise(self.distance_noise, count)
+        ratio = labels['ratio'] + self.noise(self.ratio_noise, count)
+
+        for i in active:
+            if detected[i]:
+                self.targets[i] = recognition.TargetData(contours[i], int(round(dx[i])),
+                                                         int(round(dy[i])), distance[i], ratio[i])
+            else:
+                self.targets[i] = None
+
+    def render(self, active):
+        """Render the frame each active drone sees"""
+        distance, yaw, offset_x, offset_y = self.camera_pose()
+        frames, _ = synthetic.render(distance[active], yaw[active], offset_x[active],
+                                     offset_y[active], shape=self.shape,
+                                     noise=self.pixel_noise, rng=self.rng)
+        return dict(zip(active, frames))
+
+    def run(self, max_time=120.0, verbose=False):
+        """Fly every drone until its FSM terminates or max_time (s) of
+simulated time passes, and return the report"""
+        count = len(self.drones)
+        outcomes = [None] * count
+        converged = [None] * count
+        transitions = collections.Counter()
+        start = time.perf_counter()
+
+        clock = fsm.clock
+        fsm.clock = lambda: self.time
+        output = open(os.devnull, 'w') if not verbose else None
+        try:
+            with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+                machines = [fsm.AlignmentFSM(identifier, control)
+                            for identifier, control in zip(self.identifiers, self.controllers)]
+                states = [type(machine.state).__name__ for machine in machines]
+                active = list(range(count))
+
+                while active and self.time < max_time:
+                    self.step()
+                    frames = self.render(active) if self.frames else {}
+                    if not self.frames:
+                        self.measure(active)
+
+                    still_active = []
+                    for i in active:
+                        state = machines[i].on_frame(frames.get(i))
+                        name = type(state).__name__ if state else 'Done'
+                        if name != states[i]:
+                            transitions['{} -> {}'.format(states[i], name)] += 1
+                        if state is None:
+                            outcomes[i] = 'aligned' if states[i] == 'Aligned' else 'lost'
+                            if outcomes[i] == 'aligned':
+                                converged[i] = self.time
+                        else:
+                            still_active.append(i)
+                        states[i] = name
+                    active = still_active
+        finally:
+            fsm.clock = clock
+            if output:
+                output.close()
+
+        for i in range(count):
+            outcomes[i] = outcomes[i] or 'timeout'
+        times = [t for t in converged if t is not None]
+        oscillations = [drone.oscillations for drone in self.drones]
+        elapsed = time.perf_counter() - start
+
+        return {'episodes': count,
+                'success_rate': outcomes.count('aligned') / count,
+                'outcomes': dict(collections.Counter(outcomes)),
+                'convergence_time': summary(times),
+                'oscillations': summary(oscillations),
+                'transitions': dict(transitions.most_common()),
+                'simulated_time': self.time,
+                'wall_time': elapsed,
+                'episodes_per_second': count / elapsed}
+
+
+def summary(values):
+    """Summarise a list of values, or None if it's empty"""
+    if not len(values):
+        return None
+    p50, p95 = np.percentile(values, (50, 95))
+    return {'mean': float(np.mean(values)), 'p50': float(p50), 'p95': float(p95),
+            'max': float(np.max(values))}
+
+def random_starts(count, distance=(1.5, 3.0), lateral=0.5, height=0.3, heading=20, rng=None):
+    """Draw count random starting poses in front of the target, uniformly
+within the given ranges (m and degrees)"""
+    rng = np.random.default_rng() if rng is None else rng
+    return np.column_stack((rng.uniform(-lateral, lateral, count),
+                            -rng.uniform(*distance, count),
+                            rng.uniform(-height, height, count),
+                            rng.uniform(-heading, heading, count)))
+
+def get_arguments():
+    ap = argparse.ArgumentParser(description='Simulate target alignment offline')
+    ap.add_argument('-n', '--episodes', type=int, default=1000, help='Number of episodes')
+    ap.add_argument('--seed', type=int, help='Random seed')
+    ap.add_argument('--rate', type=int, default=30, help='Frames per second')
+    ap.add_argument('--max-time', type=float, default=120.0, help='Simulated seconds per episode')
+    ap.add_argument('--latency', type=int, default=0, help='Frames of measurement latency')
+    ap.add_argument('--pixel-noise', type=float, default=0.0, help='Noise of dx and dy (pixels)')
+    ap.add_argument('--distance-noise', type=float, default=0.0, help='Noise of distance (m)')
+    ap.add_argument('--ratio-noise', type=float, default=0.0, help='Noise of ratio')
+    ap.add_argument('--dropout', type=float, default=0.0, help='Probability of a missed detection')
+    ap.add_argument('--frames', action='store_true', help='Render frames and run recognition')
+    for name in ('radius_centered', 'distance_min', 'distance_max', 'ratio_min', 'ratio_max'):
+        ap.add_argument('--' + name.replace('_', '-'), type=float,
+                        default=getattr(fsm, name), help='Override fsm.' + name)
+    ap.add_argument('--control-mode', choices=('bang_bang', 'pid'), default=fsm.control_mode,
+                    help='Override fsm.control_mode')
+    ap.add_argument('-v', '--verbose', action='store_true', help='Print the FSM messages')
+    ap.add_argument('-o', '--output', help='Write the report to this file')
+    return ap.parse_args()
+
+def main():
+    args = get_arguments()
+    for name in ('radius_centered', 'distance_min', 'distance_max', 'ratio_min', 'ratio_max'):
+        setattr(fsm, name, getattr(args, name))
+    fsm.control_mode = args.control_mode
+
+    rng = np.random.default_rng(args.seed)
+    simulation = Simulation(random_starts(args.episodes, rng=rng), rate=args.rate,
+                            latency=args.latency, pixel_noise=args.pixel_noise,
+                            distance_noise=args.distance_noise, ratio_noise=args.ratio_noise,
+                            dropout=args.dropout, frames=args.frames, rng=rng)
+    report = simulation.run(args.max_time, args.verbose)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Module for flying a swarm of Tello EDU drones from one process"""
+import statistics
+import concurrent.futures
+from network import Network, CommandClient
+from drone import Drone
+
+
+class Swarm:
+    """Flies several Tello EDU drones in station mode, given their IP
+addresses. All commands go through one CommandClient, so a single
+socket and event loop serve the whole swarm while each drone has its
+own queue of commands.
+
+Calling a Drone method on the swarm calls it on every drone in
+parallel and returns the results in the order of ips, e.g.
+
+with Swarm(['192.168.0.101', '192.168.0.102']) as swarm:
+    swarm.takeoff()
+    swarm.go(100, 0, 50)
+    print(swarm.battery())
+
+Use map() to give each drone different arguments.
+
+    """
+    def __init__(self, ips, port=8889):
+        self.ips = list(ips)
+        self.client = CommandClient(port)
+        self.drones = [Drone('swarm', network=Network(ip, port, client=self.client))
+                       for ip in self.ips]
+        # the threads only wait for responses, all I/O happens on the event loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.ips))
+
+    def __enter__(self):
+        """Prompt every drone to receive text commands"""
+        self.parallel(lambda drone: drone.network.sendrecv('command'))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Land every drone at the end of a with-statement or when an error
+occurs"""
+        try:
+            self.land()
+        finally:
+            for drone in self.drones:
+                drone.network.close()
+            self.client.close()
+            self.executor.shutdown()
+
+        if exc_type is not None:
+            print(exc_value)
+            return True
+
+    def __getattr__(self, name):
+        """Fan out calls of Drone methods to every drone"""
+        if name.startswith('_') or not callable(getattr(Drone, name, None)):
+            raise AttributeError(name)
+
+        def fan_out(*args, **kwargs):
+            return self.parallel(lambda drone: getattr(drone, name)(*args, **kwargs))
+        return fan_out
+
+    def parallel(self, func):
+        """Call func(drone) for every drone in parallel and return the list of
+results. Raises RuntimeError naming the drones that failed, once all
+calls have finished."""
+        futures = [self.executor.submit(func, drone) for drone in self.drones]
+        results = []
+        errors = []
+        for ip, future in zip(self.ips, futures):
+            try:
+                results.append(future.result())
+            except Exception as err:
+                results.append(None)
+                errors.append('{}: {}'.format(ip, err))
+
+        if errors:
+            raise RuntimeError('Error in swarm: {}'.format('; '.join(errors)))
+        return results
+
+    def map(self, name, arguments):
+        """Call the Drone method name on every drone in parallel, the i-th
+drone with the i-th tuple of arguments"""
+        calls = dict(zip(self.drones, arguments))
+        return self.parallel(lambda drone: getattr(drone, name)(*calls[drone]))
+
+    def latency_stats(self):
+        """Return the number, mean, median and maximum of the command round
+trip times (s) for each drone"""
+        stats = {}
+        for drone, ip in zip(self.drones, self.ips):
+            latencies = self.client.latencies[drone.network.address]
+            if latencies:
+                stats[ip] = {'count': len(latencies),
+                             'mean': statistics.mean(latencies),
+                             'median': statistics.median(latencies),
+                             'max': max(latencies)}
+            else:
+                stats[ip] = {'count': 0}
+        return stats
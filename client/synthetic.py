@@ -0,0 +1,178 @@
+"""Module for rendering synthetic frames of the target, to test and
+benchmark recognition without a drone.
+
+The target (outer and inner concentric squares) is placed in front of a
+pinhole camera with the same geometry recognition.distance() assumes: a
+15.25 cm target that is 136 pixels tall at 1 m. Frames are rendered in
+batches with NumPy, each with a label of the pose and of the values
+recognition should measure.
+
+USAGE: python synthetic.py corpus.npz --count 1000
+"""
+import argparse
+import numpy as np
+import cv2
+import recognition
+
+# target geometry, see recognition.distance()
+target_size = 0.1525 # m
+pixel_factor = 136.0 # height in pixels of the target at 1 m
+focal_length = pixel_factor / target_size # pixels
+inner_fraction = 0.5 # size of the inner square relative to the outer
+subpixel_bits = 4 # fractional bits of the corners when filling squares
+
+# ground truth of a frame
+label_dtype = np.dtype([('distance', 'f8'), # m, along the camera axis
+                        ('yaw', 'f8'), # degrees, positive turns the right edge away
+                        ('offset_x', 'f8'), # m, target right of the camera axis
+                        ('offset_y', 'f8'), # m, target above the camera axis
+                        ('dx', 'f8'), # pixels, as recognition.centroid_displacement
+                        ('dy', 'f8'),
+                        ('ratio', 'f8'), # as recognition.vertical_line_ratio
+                        ('pixel_distance', 'f8'), # as recognition.distance
+                        ('visible', '?')]) # whole target in view
+
+def color_bgr(color):
+    """BGR color in the middle of a color's HSV thresholds"""
+    lower, upper = recognition.thresholds[color]
+    hsv = np.uint8([[[(l + u) // 2 for l, u in zip(lower, upper)]]])
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0]
+
+def project(distance, yaw=0.0, offset_x=0.0, offset_y=0.0, size=target_size,
+            shape=(720, 960)):
+    """Project squares of the given size (m) at each pose into an image of
+shape (height, width). Returns (N, 4, 2) pixel corners ordered top
+left, top right, bottom right, bottom left, and the (N,) depth of the
+nearest corner."""
+    distance, yaw, offset_x, offset_y = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(x, dtype=float)) for x in (distance, yaw, offset_x, offset_y)])
+    height, width = shape
+    half = size / 2
+    x = np.array([-half, half, half, -half])
+    y = np.array([half, half, -half, -half])
+
+    angle = np.radians(yaw)[:, None]
+    cam_x = offset_x[:, None] + x * np.cos(angle)
+    cam_y = offset_y[:, None] + y
+    cam_z = distance[:, None] + x * np.sin(angle)
+
+    corners = np.empty(cam_x.shape + (2,))
+    corners[..., 0] = width / 2 + focal_length * cam_x / cam_z
+    corners[..., 1] = height / 2 - focal_length * cam_y / cam_z
+    return corners, cam_z.min(axis=1)
+
+def labels_for(distance, yaw=0.0, offset_x=0.0, offset_y=0.0, shape=(720, 960)):
+    """Ground truth labels (label_dtype) of the target at each pose"""
+    corners, depth = project(distance, yaw, offset_x, offset_y, shape=shape)
+    center, _ = project(distance, yaw, offset_x, offset_y, size=0.0, shape=shape)
+    height, width = shape
+
+    labels = np.zeros(len(corners), dtype=label_dtype)
+    labels['distance'] = distance
+    labels['yaw'] = yaw
+    labels['offset_x'] = offset_x
+    labels['offset_y'] = offset_y
+    labels['dx'] = center[:, 0, 0] - width // 2
+    labels['dy'] = height // 2 - center[:, 0, 1]
+    left = corners[:, 3, 1] - corners[:, 0, 1]
+    right = corners[:, 2, 1] - corners[:, 1, 1]
+    labels['ratio'] = left / right
+    labels['pixel_distance'] = pixel_factor / ((left + right) / 2)
+    labels['visible'] = ((depth > 0) &
+                         (corners[..., 0] >= 0).all(axis=1) & (corners[..., 0] < width).all(axis=1) &
+                         (corners[..., 1] >= 0).all(axis=1) & (corners[..., 1] < height).all(axis=1))
+    return labels
+
+def fill_quads(frames, corners, color):
+    """Fill a convex quadrilateral in each frame with color, with the
+corners rounded to 1 / 2**subpixel_bits pixel"""
+    scale = 1 << subpixel_bits
+    # pixel (x, y) covers x to x + 1, OpenCV puts its center at x
+    points = np.rint((corners - 0.5) * scale)
+    color = tuple(int(c) for c in np.atleast_1d(color))
+    for frame, quad in zip(frames, points):
+        # skip targets behind the camera or too close to project
+        if np.isfinite(quad).all() and np.abs(quad).max() < 1 << 24:
+            cv2.fillConvexPoly(frame, quad.astype(np.int32), color, shift=subpixel_bits)
+
+def render(distance, yaw=0.0, offset_x=0.0, offset_y=0.0, shape=(720, 960),
+           noise=0.0, blur=0.0, background=90, color_outer='fuschia',
+           color_inner='blue', rng=None, chunk=None):
+    """Render a BGR frame of the target at each pose. noise is the standard
+deviation of Gaussian pixel noise and blur the sigma (pixels) of a
+Gaussian blur. Returns the (N, height, width, 3) frames and their
+labels."""
+    rng = np.random.default_rng() if rng is None else rng
+    labels = labels_for(distance, yaw, offset_x, offset_y, shape)
+    outer, _ = project(labels['distance'], labels['yaw'], labels['offset_x'],
+                       labels['offset_y'], shape=shape)
+    inner, _ = project(labels['distance'], labels['yaw'], labels['offset_x'],
+                       labels['offset_y'], size=target_size * inner_fraction, shape=shape)
+
+    height, width = shape
+    frames = np.empty((len(labels), height, width, 3), dtype=np.uint8)
+    # bound the memory used by the noise
+    chunk = chunk or max(1, (1 << 24) // (height * width))
+    for start in range(0, len(labels), chunk):
+        batch = frames[start:start+chunk]
+        batch[...] = background
+        fill_quads(batch, outer[start:start+chunk], color_bgr(color_outer))
+        fill_quads(batch, inner[start:start+chunk], color_bgr(color_inner))
+        if noise > 0:
+            noisy = batch + rng.normal(0, noise, batch.shape)
+            np.clip(noisy, 0, 255, out=noisy)
+            batch[...] = noisy
+        if blur > 0:
+            for frame in batch:
+                cv2.GaussianBlur(frame, (0, 0), blur, dst=frame)
+    return frames, labels
+
+def random_poses(count, distance=(0.5, 3.0), yaw=(-40, 40), offset=0.3, rng=None):
+    """Draw count random poses, uniformly within the given ranges, as
+(distance, yaw, offset_x, offset_y) arrays"""
+    rng = np.random.default_rng() if rng is None else rng
+    return (rng.uniform(*distance, count), rng.uniform(*yaw, count),
+            rng.uniform(-offset, offset, count), rng.uniform(-offset, offset, count))
+
+def evaluate(identifier, frames, labels):
+    """Run the identifier over labelled frames and compare what it measures
+with the ground truth. Returns the detection rate on visible targets
+and the mean absolute errors of distance (against pixel_distance and
+the true distance), ratio, dx and dy."""
+    found = []
+    errors = {'distance': [], 'true_distance': [], 'ratio': [], 'dx': [], 'dy': []}
+    for frame, label in zip(frames, labels):
+        if not label['visible']:
+            continue
+        target = identifier.find_target(frame.copy())
+        found.append(target is not None)
+        if target is not None:
+            errors['distance'].append(abs(target.distance - label['pixel_distance']))
+            errors['true_distance'].append(abs(target.distance - label['distance']))
+            errors['ratio'].append(abs(target.ratio - label['ratio']))
+            errors['dx'].append(abs(target.dx - label['dx']))
+            errors['dy'].append(abs(target.dy - label['dy']))
+
+    report = {'detection_rate': float(np.mean(found)) if found else 0.0}
+    for name, values in errors.items():
+        report[name + '_error'] = float(np.mean(values)) if values else None
+    return report
+
+def get_arguments():
+    ap = argparse.ArgumentParser(description='Render a corpus of synthetic target frames')
+    ap.add_argument('output', help='.npz file to write frames and labels to')
+    ap.add_argument('-n', '--count', type=int, default=100, help='Number of frames')
+    ap.add_argument('--noise', type=float, default=4.0, help='Pixel noise standard deviation')
+    ap.add_argument('--blur', type=float, default=1.0, help='Blur sigma (pixels)')
+    ap.add_argument('--seed', type=int, help='Random seed')
+    return ap.parse_args()
+
+def main():
+    args = get_arguments()
+    rng = np.random.default_rng(args.seed)
+    frames, labels = render(*random_poses(args.count, rng=rng), noise=args.noise,
+                            blur=args.blur, rng=rng)
+    np.savez(args.output, frames=frames, labels=labels)
+
+if __name__ == '__main__':
+    main()
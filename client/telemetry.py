@@ -0,0 +1,109 @@
+"""Module for receiving the state telemetry that the drone broadcasts"""
+import time
+import threading
+import socket
+import numpy as np
+
+# numeric fields of the state string, see the Tello SDK 2.0 User Guide
+fields = ('mid', 'x', 'y', 'z', 'pitch', 'roll', 'yaw', 'vgx', 'vgy', 'vgz',
+          'templ', 'temph', 'tof', 'h', 'bat', 'baro', 'time', 'agx', 'agy', 'agz')
+
+# one telemetry sample, fields missing from a packet are NaN
+sample_dtype = np.dtype([('timestamp', 'f8')] + [(name, 'f4') for name in fields])
+
+def parse_state(packet):
+    """Parse a state packet, e.g. b'pitch:0;roll:2;yaw:-45;...;bat:87;...'
+into a dictionary of field -> float. Fields that aren't a single
+number (mpry) are skipped."""
+    state = {}
+    for item in packet.decode('ascii', errors='replace').strip().split(';'):
+        name, _, value = item.partition(':')
+        if name in fields:
+            try:
+                state[name] = float(value)
+            except ValueError:
+                pass
+    return state
+
+
+class Telemetry:
+    """Listens for the state the drone broadcasts on UDP port 8890 about
+ten times a second once it is in command mode.
+
+The latest values are cached, so get() answers without a round trip
+to the drone. The last capacity samples are kept in a preallocated
+ring of numeric samples (sample_dtype) which as_array() exports as a
+NumPy structured array, oldest sample first. The packets are recorded
+to recorder, a recorder.FlightRecorder, if one is given.
+
+The socket times out every receive_timeout seconds so that the thread
+notices stop() even when the drone has stopped broadcasting, and the
+port is free again once stop() returns.
+
+    """
+    receive_timeout = 0.5
+
+    def __init__(self, ip='0.0.0.0', port=8890, capacity=6000, recorder=None):
+        self.samples = np.zeros(capacity, dtype=sample_dtype)
+        self.count = 0 # total samples received
+        self.state = {}
+        self.timestamp = None
+        self.lock = threading.Lock()
+        self.recorder = recorder
+
+        self.socket_state = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket_state.bind((ip, port))
+        self.socket_state.settimeout(self.receive_timeout)
+
+        self.receiving = True
+        self.thread_state = threading.Thread(target=self.recv_state)
+        self.thread_state.daemon = True
+        self.thread_state.start()
+
+    def recv_state(self):
+        while self.receiving:
+            try:
+                packet, ip = self.socket_state.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except socket.error as err:
+                if self.receiving:
+                    print("Caught exception socket.error : {}".format(err))
+                continue
+
+            if self.recorder:
+                self.recorder.record('telemetry', packet)
+            state = parse_state(packet)
+            if state:
+                self.add_sample(time.monotonic(), state)
+
+    def add_sample(self, timestamp, state):
+        """Cache the state and store it in the ring"""
+        sample = (timestamp,) + tuple(state.get(name, np.nan) for name in fields)
+        with self.lock:
+            self.samples[self.count % len(self.samples)] = sample
+            self.count += 1
+            self.state = state
+            self.timestamp = timestamp
+
+    def get(self, name, max_age=1.0):
+        """Return the latest value of a field, or None if it's unknown or
+older than max_age seconds"""
+        with self.lock:
+            if self.timestamp is None or time.monotonic() - self.timestamp > max_age:
+                return None
+            return self.state.get(name)
+
+    def as_array(self):
+        """Return a copy of the stored samples, oldest first"""
+        with self.lock:
+            capacity = len(self.samples)
+            if self.count <= capacity:
+                return self.samples[:self.count].copy()
+            start = self.count % capacity
+            return np.concatenate((self.samples[start:], self.samples[:start]))
+
+    def stop(self):
+        self.receiving = False
+        self.thread_state.join()
+        self.socket_state.close()
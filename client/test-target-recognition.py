@@ -14,7 +14,7 @@ drone = drone.Drone()
 drone.battery()
 
 while True:
-    frame = drone.get_frame()
+    frame = drone.video.get_frame()
     identifier.find_target(frame)
 
     cv2.imshow('window', frame)
@@ -0,0 +1,191 @@
+"""Tune the HSV thresholds of the target's colors over a labeled corpus
+of frames, instead of one frame at a time with ColorPicker.py.
+
+Every frame is preprocessed as recognition does, and the HSV values of
+its pixels are counted in two 3D histograms per color: pixels of that
+color and all other pixels. Summed-area tables of the histograms give
+the number of pixels inside any HSV box with 8 lookups, so thousands of
+candidate thresholds are scored at once with NumPy. Coordinate descent
+then moves one bound at a time to the value that maximises the F1 score
+of the pixels the thresholds select, until no bound improves it.
+
+The corpus is an .npz file with the BGR 'frames' and either the masks
+of the target's squares as 'outer' and 'inner' arrays (N, height,
+width), nonzero where the square's color is, or the 'labels' of a
+synthetic.py corpus.
+
+USAGE: python tune_thresholds.py corpus.npz --outer fuschia --inner blue -o venue.json
+       then recognition.load_thresholds('venue.json')
+"""
+import argparse
+import numpy as np
+import recognition
+import synthetic
+
+# histogram bin widths of hue, saturation and value; hue is 0-179 in OpenCV
+bin_widths = (2, 4, 4)
+value_ranges = (180, 256, 256)
+
+def bin_counts(widths=bin_widths):
+    return tuple(-(-size // width) for size, width in zip(value_ranges, widths))
+
+def masks_from_labels(labels, shape):
+    """Masks of the outer and inner squares of synthetic frames"""
+    outer, _ = synthetic.project(labels['distance'], labels['yaw'], labels['offset_x'],
+                                 labels['offset_y'], shape=shape)
+    inner, _ = synthetic.project(labels['distance'], labels['yaw'], labels['offset_x'],
+                                 labels['offset_y'], size=synthetic.target_size *
+                                 synthetic.inner_fraction, shape=shape)
+    masks = {'outer': np.zeros((len(labels),) + shape, dtype=np.uint8),
+             'inner': np.zeros((len(labels),) + shape, dtype=np.uint8)}
+    for i in range(len(labels)):
+        synthetic.fill_quads(masks['outer'][i:i+1], outer[i:i+1], 1)
+        synthetic.fill_quads(masks['inner'][i:i+1], inner[i:i+1], 1)
+    masks['outer'][masks['inner'] > 0] = 0
+    return masks
+
+def load_labeled_corpus(path):
+    """Load the frames of a corpus and the masks of its outer and inner squares"""
+    with np.load(path) as corpus:
+        frames = corpus['frames']
+        if 'outer' in corpus and 'inner' in corpus:
+            masks = {'outer': corpus['outer'], 'inner': corpus['inner']}
+        else:
+            masks = masks_from_labels(corpus['labels'], frames.shape[1:3])
+    return frames, masks
+
+def histograms(frames, masks, widths=bin_widths, preprocess=True):
+    """Count the binned HSV values of the pixels in each mask and of the
+pixels outside it. Returns {name: (positives, negatives)} of 3D histograms."""
+    bins = bin_counts(widths)
+    size = int(np.prod(bins))
+    counts = {name: [np.zeros(size, dtype=np.int64) for _ in range(2)] for name in masks}
+    for i, frame in enumerate(frames):
+        hsv = recognition.preprocess(frame) if preprocess else frame
+        h, s, v = (hsv[..., c].ravel() // widths[c] for c in range(3))
+        index = (h.astype(np.int64) * bins[1] + s) * bins[2] + v
+        total = np.bincount(index, minlength=size)
+        for name, mask in masks.items():
+            positive = np.bincount(index[mask[i].ravel() > 0], minlength=size)
+            counts[name][0] += positive
+            counts[name][1] += total - positive
+    return {name: (positive.reshape(bins), negative.reshape(bins))
+            for name, (positive, negative) in counts.items()}
+
+def summed_area_table(histogram):
+    """Cumulative counts with a row of zeros before each axis, so that
+table[i, j, k] counts the bins below (i, j, k)"""
+    table = np.zeros(tuple(n + 1 for n in histogram.shape), dtype=np.int64)
+    table[1:, 1:, 1:] = histogram.cumsum(0).cumsum(1).cumsum(2)
+    return table
+
+def box_counts(table, lower, upper):
+    """Counts inside the boxes of bins lower to upper (inclusive), both
+(K, 3) arrays, by inclusion-exclusion on the summed-area table"""
+    lo = lower.T
+    hi = upper.T + 1
+    return (table[hi[0], hi[1], hi[2]] - table[lo[0], hi[1], hi[2]]
+            - table[hi[0], lo[1], hi[2]] - table[hi[0], hi[1], lo[2]]
+            + table[lo[0], lo[1], hi[2]] + table[lo[0], hi[1], lo[2]]
+            + table[hi[0], lo[1], lo[2]] - table[lo[0], lo[1], lo[2]])
+
+def f1_scores(positives, negatives, total_positives, lower, upper):
+    """F1 score of selecting the pixels in each box"""
+    tp = box_counts(positives, lower, upper)
+    fp = box_counts(negatives, lower, upper)
+    return 2 * tp / np.maximum(2 * tp + fp + (total_positives - tp), 1)
+
+def coordinate_descent(positives, negatives, lower, upper, max_sweeps=50):
+    """Move one bound at a time to its best value, trying every value at
+once, until a sweep over all six bounds doesn't improve the F1 score.
+Returns the best (lower, upper) bins and their F1 score."""
+    total = positives[-1, -1, -1]
+    lower = np.array(lower)
+    upper = np.array(upper)
+    best = f1_scores(positives, negatives, total, lower[None], upper[None])[0]
+    for _ in range(max_sweeps):
+        improved = False
+        for axis in range(3):
+            for bound in (lower, upper):
+                values = (np.arange(0, upper[axis] + 1) if bound is lower else
+                          np.arange(lower[axis], positives.shape[axis] - 1))
+                lowers = np.repeat(lower[None], len(values), axis=0)
+                uppers = np.repeat(upper[None], len(values), axis=0)
+                (lowers if bound is lower else uppers)[:, axis] = values
+                scores = f1_scores(positives, negatives, total, lowers, uppers)
+                i = int(np.argmax(scores))
+                if scores[i] > best + 1e-9:
+                    best = scores[i]
+                    bound[axis] = values[i]
+                    improved = True
+        if not improved:
+            break
+    return lower, upper, best
+
+def to_bins(threshold, widths=bin_widths):
+    lower, upper = threshold
+    bins = bin_counts(widths)
+    return (np.minimum(np.array(lower) // widths, np.array(bins) - 1),
+            np.minimum(np.array(upper) // widths, np.array(bins) - 1))
+
+def to_threshold(lower, upper, widths=bin_widths):
+    """HSV bounds covering the bins lower to upper"""
+    return (tuple(int(l * w) for l, w in zip(lower, widths)),
+            tuple(int(min((u + 1) * w, size) - 1) for u, w, size in zip(upper, widths, value_ranges)))
+
+def tune(positive, negative, threshold=None, widths=bin_widths):
+    """Find the HSV threshold that maximises F1 for one color, starting from
+the given threshold, from the whole range and from the bins most of the
+color's pixels fall in. Returns (threshold, f1, f1 of the given threshold)."""
+    positives = summed_area_table(positive)
+    negatives = summed_area_table(negative)
+    total = positives[-1, -1, -1]
+    bins = bin_counts(widths)
+
+    starts = [(np.zeros(3, dtype=int), np.array(bins) - 1)]
+    # the bins from the 1st to the 99th percentile of the color's pixels
+    # along each axis
+    lower, upper = [], []
+    for axis in range(3):
+        cumulative = positive.sum(axis=tuple(a for a in range(3) if a != axis)).cumsum()
+        lower.append(np.searchsorted(cumulative, 0.01 * total))
+        upper.append(np.searchsorted(cumulative, 0.99 * total))
+    starts.append((np.array(lower), np.minimum(upper, np.array(bins) - 1)))
+    initial = None
+    if threshold is not None:
+        start = to_bins(threshold, widths)
+        starts.insert(0, start)
+        initial = f1_scores(positives, negatives, total, start[0][None], start[1][None])[0]
+
+    results = [coordinate_descent(positives, negatives, *start) for start in starts]
+    lower, upper, best = max(results, key=lambda result: result[2])
+    return to_threshold(lower, upper, widths), float(best), initial
+
+def get_arguments():
+    ap = argparse.ArgumentParser(description='Tune HSV thresholds over a labeled corpus')
+    ap.add_argument('corpus', help='.npz file of frames and masks or synthetic labels')
+    ap.add_argument('--outer', default='fuschia', help='Color of the outer square')
+    ap.add_argument('--inner', default='blue', help='Color of the inner square')
+    ap.add_argument('--bins', type=int, nargs=3, default=bin_widths,
+                    help='Histogram bin widths of hue, saturation and value')
+    ap.add_argument('-o', '--output', help='Profile to write the thresholds to')
+    return ap.parse_args()
+
+def main():
+    args = get_arguments()
+    frames, masks = load_labeled_corpus(args.corpus)
+    counts = histograms(frames, masks, tuple(args.bins))
+
+    for name, color in (('outer', args.outer), ('inner', args.inner)):
+        threshold, f1, initial = tune(*counts[name], recognition.thresholds.get(color),
+                                      tuple(args.bins))
+        print('{:10} {} -> {}  F1 {} -> {:.3f}'.format(
+            color, recognition.thresholds.get(color), threshold,
+            'n/a' if initial is None else '{:.3f}'.format(initial), f1))
+        recognition.thresholds[color] = threshold
+
+    if args.output:
+        recognition.save_thresholds(args.output, (args.outer, args.inner))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Module for checking mission scripts against flight limits before
+flying them. Missions are planned headless, in parallel, and each gets
+a short report.
+
+USAGE: python validator.py mission1.py mission2.py ...
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import multiprocessing
+import runpy
+import numpy as np
+import planner
+import drone
+from drone import Drone
+
+# Default flight limits: the horizontal area ((x_min, x_max), (y_min,
+# y_max)) the drone must stay within and the maximum altitude, in cm
+# from the take off point
+geofence = ((-500, 500), (-500, 500))
+ceiling = 300
+
+# valid range of the speed argument of go (cm/s)
+go_speed_range = (10, 100)
+
+def run_script(path):
+    """Run a mission script with every drone replaced by a headless planner.
+Returns the commands sent and the error that cut the mission short, or
+None."""
+    # the flags are put back afterwards, so that drones created later in
+    # this process fly again
+    saved = drone.planner_only, planner.headless, planner.completed[:]
+    drone.planner_only = True
+    planner.headless = True
+    del planner.completed[:]
+    error = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                runpy.run_path(path, run_name='__main__')
+            except (Exception, SystemExit) as err:
+                # a script may call sys.exit(), it mustn't end the
+                # validator or hang the pool process running it
+                error = err
+        completed = planner.completed[:]
+    finally:
+        drone.planner_only, planner.headless, planner.completed[:] = saved
+
+    commands = [command for p in completed for command in p.command_history]
+    errors = [describe_error(p.error) for p in completed]
+    errors = [message for message in [describe_error(error)] + errors if message is not None]
+    return commands, errors[0] if errors else None
+
+def describe_error(error):
+    """Message of the error that cut a mission short, None if there was
+none or the script exited with status 0"""
+    if isinstance(error, SystemExit):
+        if error.code in (None, 0):
+            return None
+        return 'exited with status {}'.format(error.code)
+    return None if error is None else str(error)
+
+def range_violations(commands):
+    """Check the arguments of each command against the ranges the Drone
+class enforces"""
+    violations = []
+    for command in commands:
+        name, *args = command.split()
+        valid_range = getattr(getattr(Drone, name, None), 'valid_range', None)
+        if valid_range is None:
+            continue
+        try:
+            values = [int(float(arg)) for arg in args]
+        except ValueError:
+            violations.append('{}: arguments must be numbers'.format(command))
+            continue
+
+        minimum, maximum = valid_range
+        distances = values[:3] if name == 'go' else values
+        if not all(minimum <= x <= maximum for x in distances):
+            msg = '{}: argument must be between {} and {}'
+            violations.append(msg.format(command, minimum, maximum))
+        if name == 'go':
+            if all(-20 < x < 20 for x in values[:3]):
+                violations.append('{}: one of x, y, z must be outside range of -20 to 20'.format(command))
+            if len(values) > 3 and not go_speed_range[0] <= values[3] <= go_speed_range[1]:
+                msg = '{}: speed must be between {} and {}'
+                violations.append(msg.format(command, *go_speed_range))
+    return violations
+
+def limit_violations(commands, positions, geofence, ceiling):
+    """Check the planned positions against the geofence and ceiling,
+reporting the first command to break each limit"""
+    moves = [command for command in commands if command.split()[:1] and
+             command.split()[0] in planner.opcodes]
+    (x_min, x_max), (y_min, y_max) = geofence
+    x, y, z = positions.T
+    checks = (('outside geofence', (x < x_min) | (x > x_max) | (y < y_min) | (y > y_max)),
+              ('above ceiling of {} cm'.format(ceiling), z > ceiling),
+              ('below ground', z < 0))
+
+    violations = []
+    for message, broken in checks:
+        if broken.any():
+            i = int(np.argmax(broken)) # position i is after move i-1
+            command = moves[i - 1] if i > 0 else 'start'
+            violations.append('{}: {} at ({:.0f}, {:.0f}, {:.0f})'.format(command, message,
+                                                                        *positions[i]))
+    return violations
+
+def validate_mission(mission, geofence=None, ceiling=None):
+    """Plan a mission, either the path of a mission script or a list of
+commands, and check it. Returns a report with the keys mission (the
+script path, None for a list of commands), ok, commands (the number
+sent), violations, error and extent (minimum and maximum position)."""
+    geofence = globals()['geofence'] if geofence is None else geofence
+    ceiling = globals()['ceiling'] if ceiling is None else ceiling
+
+    if isinstance(mission, str):
+        name = mission
+        commands, error = run_script(mission)
+    else:
+        name = None
+        commands, error = list(mission), None
+
+    # a blank command would be rejected by the drone, report it rather
+    # than let it stop the planning
+    violations = ['command {}: blank command'.format(i)
+                  for i, command in enumerate(commands) if not command.strip()]
+    commands = [command for command in commands if command.strip()]
+    violations += range_violations(commands)
+    try:
+        positions, directions = planner.compute_poses(*planner.parse_commands(commands))
+    except ValueError as err:
+        # the arguments that aren't numbers are reported by range_violations
+        violations.append('path not planned: {}'.format(err))
+        positions = np.zeros((1, 3))
+    else:
+        violations += limit_violations(commands, positions, geofence, ceiling)
+    return {'mission': name,
+            'ok': not violations and error is None,
+            'commands': len(commands),
+            'violations': violations,
+            'error': error,
+            'extent': [positions.min(axis=0).tolist(), positions.max(axis=0).tolist()]}
+
+def validate_missions(missions, geofence=None, ceiling=None, processes=None):
+    """Validate many missions in a pool of processes, see validate_mission().
+Missions given as lists of commands are named by their index."""
+    check = functools.partial(validate_mission, geofence=geofence, ceiling=ceiling)
+    with multiprocessing.Pool(processes) as pool:
+        reports = pool.map(check, missions)
+
+    for i, report in enumerate(reports):
+        if report['mission'] is None:
+            report['mission'] = i
+    return reports
+
+def get_arguments():
+    ap = argparse.ArgumentParser(description='Check mission scripts without flying')
+    ap.add_argument('scripts', nargs='+', help='Mission scripts')
+    ap.add_argument('-c', '--ceiling', type=float, default=ceiling,
+                    help='Maximum altitude (cm)')
+    ap.add_argument('-g', '--geofence', type=float, nargs=4,
+                    metavar=('X_MIN', 'X_MAX', 'Y_MIN', 'Y_MAX'),
+                    help='Horizontal area to stay within (cm)')
+    ap.add_argument('-p', '--processes', type=int, help='Number of processes')
+    ap.add_argument('-j', '--json', action='store_true', help='Print the reports as JSON')
+    return ap.parse_args()
+
+def main():
+    args = get_arguments()
+    fence = geofence
+    if args.geofence:
+        x_min, x_max, y_min, y_max = args.geofence
+        fence = ((x_min, x_max), (y_min, y_max))
+
+    reports = validate_missions(args.scripts, fence, args.ceiling, args.processes)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+
+    for report in reports:
+        status = 'ok' if report['ok'] else 'FAIL'
+        print('{:4} {} ({} commands)'.format(status, report['mission'], report['commands']))
+        for violation in report['violations']:
+            print('     {}'.format(violation))
+        if report['error']:
+            print('     error: {}'.format(report['error']))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 """Module for capturing and displaying video from the drone or a webcam"""
+import os
 import time
 import threading
 import multiprocessing
+from multiprocessing import shared_memory
 import socket
 import sys
 sys.path.append('.') # to find module libh264decoder
@@ -10,27 +12,71 @@ import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import libh264decoder
 import cv2
+import recorder
 plt.rcParams['toolbar'] = 'None'
 
-class Webcam:
+class FrameSource:
+    """Base class for sources of video frames. Every new frame is given a
+frame id, counting up from 1, and the time it arrived
+(time.monotonic). A consumer that remembers the id of the last frame
+it processed can call wait_for_next_frame() to block until a newer one
+arrives, so it never processes the same frame twice.
+
+Derived classes call set_frame() for every new frame.
+
+    """
     def __init__(self):
         self.frame = None
+        self.frame_id = 0
+        self.timestamp = None
+        self.frame_ready = threading.Condition()
+
+    def set_frame(self, frame, timestamp=None):
+        """Publish a new frame and wake up any waiting consumers. The frame
+arrived now unless timestamp says otherwise."""
+        with self.frame_ready:
+            self.frame = frame
+            self.frame_id += 1
+            self.timestamp = time.monotonic() if timestamp is None else timestamp
+            self.frame_ready.notify_all()
+
+    def convert(self, frame):
+        """Convert a stored frame to the BGR frame returned to consumers"""
+        return frame
+
+    def wait_for_next_frame(self, after_id=0, timeout=None):
+        """Wait until there is a frame with an id greater than after_id and
+return (frame_id, timestamp, frame), or None if the timeout (s) expires"""
+        with self.frame_ready:
+            if not self.frame_ready.wait_for(lambda: self.frame_id > after_id, timeout):
+                return None
+            frame_id, timestamp, frame = self.frame_id, self.timestamp, self.frame
+        return frame_id, timestamp, self.convert(frame)
+
+    def get_frame(self):
+        """Return the latest frame, waiting for the first one to arrive"""
+        frame_id, timestamp, frame = self.wait_for_next_frame()
+        return frame
+
+
+class Webcam(FrameSource):
+    """Frames of the first webcam. The attribute shape is the (height,
+width, channels) of its frames."""
+    def __init__(self):
+        super().__init__()
+        self.capture = cv2.VideoCapture(0)
+        height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.shape = (height, width, 3) if height > 0 and width > 0 else (720, 960, 3)
         self.capturing = True
         self.thread_video = threading.Thread(target=self.recv_video)
         self.thread_video.start()
 
-    def get_frame(self):
-        while self.frame is None:
-            time.sleep(0.1)
-
-        return self.frame
-        
     def recv_video(self):
-        self.capture = cv2.VideoCapture(0)
-        
         while self.capturing:
-            _, frame = self.capture.read()
-            self.frame = frame
+            ret, frame = self.capture.read()
+            if ret:
+                self.set_frame(frame)
 
         self.capture.release()
 
@@ -38,37 +84,93 @@ class Webcam:
         self.capturing = False
 
 
-class Video:
-    def __init__(self, ip='0.0.0.0', port=11111):
-        # socket settings for the video stream
-        self.socket_video = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket_video.bind(('0.0.0.0', 11111))
-        libh264decoder.disable_logging()
-        self.decoder = libh264decoder.H264Decoder()
-        self.frame = None # current video frame stored as a numpy array of RGB
+class Video(FrameSource):
+    """Receives the H.264 video stream from the drone and decodes it into
+frames.
+
+The packets of each access unit are received straight into a
+preallocated buffer with recvfrom_into and the decoder is handed a view
+of it, so the stream is never copied in Python. The attribute stats
+counts the packets and frames received, the packets that were larger
+than the drone ever sends (oversized) and the access units that had to
+be dropped because they were malformed or did not fit in the buffer.
+The access units are recorded to recorder, a recorder.FlightRecorder,
+if one is given.
+
+    """
+    packet_size = 1460 # size of every packet except the last of an access unit
+    max_packet_size = 2048
+    buffer_size = 1 << 20 # room for the largest access unit we expect
+    decoder_takes_views = True # False for libh264decoder builds that only take bytes
+
+    def __init__(self, ip='0.0.0.0', port=11111, recorder=None):
+        super().__init__() # frames are stored as numpy arrays of RGB
+        self.open_stream(ip, port)
+        self.recorder = recorder
 
         self.capturing = True
         self.thread_video = threading.Thread(target=self.recv_video)
         self.thread_video.daemon = True
         self.thread_video.start()
 
+    def open_stream(self, ip, port):
+        """Bind the socket for the video stream and create the decoder"""
+        self.socket_video = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket_video.bind((ip, port))
+        libh264decoder.disable_logging()
+        self.decoder = libh264decoder.H264Decoder()
+        self.stats = {'packets': 0, 'frames': 0, 'oversized': 0, 'dropped': 0}
+
     def recv_video(self):
-        packet_data = b''
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        size = 0 # bytes of the current access unit received so far
+        discard = False # drop the current access unit when it ends
         while self.capturing:
             try:
-                data, ip = self.socket_video.recvfrom(2048)
-                packet_data += data
-                if len(data) != 1460:
-                    for frame in self.decode_h264(packet_data):
-                        self.frame = frame
-                    packet_data = b''
+                if size + self.max_packet_size > len(buffer):
+                    # access unit won't fit, reuse the buffer until it ends
+                    discard = True
+                    size = 0
+
+                nbytes, ip = self.socket_video.recvfrom_into(view[size:], self.max_packet_size)
+                self.stats['packets'] += 1
+                if nbytes > self.packet_size:
+                    self.stats['oversized'] += 1
+                    discard = True
+                size += nbytes
 
+                if nbytes != self.packet_size:
+                    if discard:
+                        self.stats['dropped'] += 1
+                    else:
+                        if self.recorder:
+                            self.recorder.record('video', view[:size])
+                        for frame in self.decode_h264(view[:size]):
+                            self.stats['frames'] += 1
+                            self.set_frame(frame)
+                    size = 0
+                    discard = False
+
+            except socket.timeout:
+                continue # check if we should still be capturing
             except socket.error as err:
                 print("Caught exception socket.error : {}".format(err))
 
     def decode_h264(self, packet_data):
         frame_list = []
-        frames = self.decoder.decode(packet_data)
+        if not self.decoder_takes_views:
+            packet_data = bytes(packet_data)
+        try:
+            frames = self.decoder.decode(packet_data)
+        except (ValueError, TypeError):
+            if isinstance(packet_data, bytes):
+                raise
+            # a libh264decoder built before it took any buffer only
+            # takes bytes, copy from now on
+            print('libh264decoder only accepts bytes, rebuild it to avoid a copy per frame')
+            self.decoder_takes_views = False
+            frames = self.decoder.decode(bytes(packet_data))
 
         for framedata in frames:
             (frame, width, height, linesize) = framedata
@@ -80,56 +182,574 @@ class Video:
 
         return frame_list
 
-    def get_frame(self):
-        while self.frame is None:
-            time.sleep(0.1)
-        return cv2.cvtColor(self.frame, cv2.COLOR_RGB2BGR)
+    def convert(self, frame):
+        return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
 
     def stop(self):
         self.capturing = False
 
 
+class ReplayVideo(Video):
+    """Replays a recorded video stream: a raw H.264 file (e.g. extracted
+with recorder.py) or a recorder.FlightRecorder log, decoded with the
+same decoder as Video.
+
+With realtime set, frames are published at the pace they were recorded
+(fps for a raw file) and, as with a live stream, a consumer that falls
+behind skips frames. Otherwise each frame is published as soon as the
+previous one has been taken with wait_for_next_frame() or get_frame(),
+so every frame is processed once, as fast as the consumer goes.
+
+Frames are timestamped with the time they were recorded (counting from
+0 at fps for a raw file). When the recording ends,
+wait_for_next_frame() returns None instead of waiting for a newer
+frame.
+
+    """
+    read_size = 1 << 16 # bytes of a raw file decoded at a time
+
+    def __init__(self, path, realtime=False, fps=30):
+        FrameSource.__init__(self)
+        self.path = path
+        self.realtime = realtime
+        self.fps = fps
+        self.recorder = None
+        self.taken = 0 # id of the latest frame taken by a consumer
+        self.finished = False
+        libh264decoder.disable_logging()
+        self.decoder = libh264decoder.H264Decoder()
+        self.stats = {'packets': 0, 'frames': 0, 'oversized': 0, 'dropped': 0}
+
+        self.capturing = True
+        self.thread_video = threading.Thread(target=self.recv_video)
+        self.thread_video.daemon = True
+        self.thread_video.start()
+
+    def access_units(self):
+        """Yield the (timestamp, data) of the recorded stream, timestamp is
+None for a raw file"""
+        files = recorder.log_files(self.path) or [self.path]
+        with open(files[0], 'rb') as f:
+            is_log = f.read(len(recorder.magic)) == recorder.magic
+        if is_log:
+            for kind, timestamp, payload in recorder.read_log(self.path):
+                if kind == 'video':
+                    yield timestamp, payload
+        else:
+            with open(self.path, 'rb') as f:
+                for data in iter(lambda: f.read(self.read_size), b''):
+                    yield None, data
+
+    def recv_video(self):
+        start = None # (time.monotonic, recorded time) of the first frame
+        try:
+            for timestamp, data in self.access_units():
+                if not self.capturing:
+                    break
+                self.stats['packets'] += 1
+                for frame in self.decode_h264(data):
+                    if not self.capturing:
+                        break
+                    recorded = self.stats['frames'] / self.fps if timestamp is None else timestamp
+                    if self.realtime:
+                        if start is None:
+                            start = (time.monotonic(), recorded)
+                        delay = start[0] + recorded - start[1] - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    else:
+                        with self.frame_ready:
+                            self.frame_ready.wait_for(lambda: (self.taken >= self.frame_id or
+                                                               not self.capturing))
+                    self.stats['frames'] += 1
+                    self.set_frame(frame, recorded)
+        except (OSError, RuntimeError) as err:
+            print("Caught exception replaying {}: {}".format(self.path, err))
+        finally:
+            with self.frame_ready:
+                self.finished = True
+                self.frame_ready.notify_all()
+
+    def wait_for_next_frame(self, after_id=0, timeout=None):
+        with self.frame_ready:
+            if not self.frame_ready.wait_for(lambda: self.frame_id > after_id or self.finished,
+                                             timeout):
+                return None
+            if self.frame_id <= after_id:
+                return None
+            frame_id, timestamp, frame = self.frame_id, self.timestamp, self.frame
+            self.taken = max(self.taken, frame_id)
+            self.frame_ready.notify_all()
+        return frame_id, timestamp, self.convert(frame)
+
+    def get_frame(self):
+        """Return the latest frame, waiting for the first one to arrive, or
+None if the recording has no frames"""
+        result = self.wait_for_next_frame()
+        return None if result is None else result[2]
+
+    def stop(self):
+        with self.frame_ready:
+            self.capturing = False
+            self.frame_ready.notify_all()
+
+
+class FrameStore:
+    """A file of decoded BGR frames for offline analysis, read through
+np.memmap so that a long recording is never loaded into memory at
+once: only the pages of the frames used are read from disk.
+
+The file has a 64 byte header (magic, frame shape, record stride and
+frame count) followed by fixed-stride records, each a timestamp (s)
+and a frame, aligned to 64 bytes. store[i] and store[i:j] are NumPy
+views of the file, not copies; index_at() and frame_at() look frames
+up by time.
+
+mode is 'r' to read, 'r+' to read and append or 'w' to create a new
+store of frames of the given shape (height, width, channels).
+
+    """
+    magic = b'TELSIMFS'
+    header_dtype = np.dtype({'names': ['magic', 'height', 'width', 'channels', 'stride', 'count'],
+                             'formats': ['S8', '<u4', '<u4', '<u4', '<u4', '<u8'],
+                             'offsets': [0, 8, 12, 16, 20, 24],
+                             'itemsize': 64})
+    grow_records = 256 # records added to the file whenever it's full
+
+    def __init__(self, path, mode='r', shape=(720, 960, 3)):
+        self.path = path
+        self.mode = mode
+        if mode == 'w':
+            with open(path, 'wb') as f:
+                f.truncate(self.header_dtype.itemsize)
+            self.header = np.memmap(path, dtype=self.header_dtype, mode='r+', shape=())
+            self.header['magic'] = self.magic
+            self.header['height'], self.header['width'], self.header['channels'] = shape
+            self.header['stride'] = self.record_dtype(shape).itemsize
+            self.header['count'] = 0
+            self.mode = 'r+'
+        else:
+            self.header = np.memmap(path, dtype=self.header_dtype, mode=mode, shape=())
+            if self.header['magic'] != self.magic:
+                raise RuntimeError('Not a frame store: {}'.format(path))
+
+        self.shape = (int(self.header['height']), int(self.header['width']),
+                      int(self.header['channels']))
+        self.dtype = self.record_dtype(self.shape)
+        if self.dtype.itemsize != self.header['stride']:
+            raise RuntimeError('Unexpected record size in frame store: {}'.format(path))
+        self.times = None # timestamps cached for lookups by time
+        self.map_records()
+
+    @staticmethod
+    def record_dtype(shape):
+        """Timestamp and frame, with the frame and stride aligned to 64 bytes"""
+        size = int(np.prod(shape))
+        return np.dtype({'names': ['timestamp', 'frame'],
+                         'formats': ['<f8', ('u1', tuple(shape))],
+                         'offsets': [0, 64],
+                         'itemsize': 64 + -(-size // 64) * 64})
+
+    def map_records(self):
+        """Map the records the file has room for"""
+        offset = self.header_dtype.itemsize
+        capacity = (os.path.getsize(self.path) - offset) // self.dtype.itemsize
+        self.records = None
+        if capacity > 0:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode=self.mode,
+                                     offset=offset, shape=(capacity,))
+
+    def __len__(self):
+        return int(self.header['count'])
+
+    def __getitem__(self, index):
+        """Frame (or frames of a slice) as a view of the file"""
+        count = len(self)
+        frames = self.records['frame'][:count] if count else np.empty((0,) + self.shape, np.uint8)
+        if isinstance(index, slice):
+            return frames[index]
+        if not -count <= index < count:
+            raise IndexError('frame index out of range')
+        return frames[index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def timestamps(self):
+        """Timestamps (s) of all frames"""
+        count = len(self)
+        if self.times is None or len(self.times) != count:
+            self.times = np.array(self.records['timestamp'][:count]) if count else np.empty(0)
+        return self.times
+
+    def index_at(self, timestamp):
+        """Index of the frame shown at a time: the last one at or before it"""
+        index = np.searchsorted(self.timestamps(), timestamp, side='right') - 1
+        return max(0, int(index))
+
+    def frame_at(self, timestamp):
+        return self[self.index_at(timestamp)]
+
+    def append(self, frame, timestamp=None):
+        """Add a frame, growing the file if it's full"""
+        if self.mode != 'r+':
+            raise RuntimeError('Frame store opened read only: {}'.format(self.path))
+        if frame.shape != self.shape:
+            msg = 'Frame of shape {} does not fit a frame store of shape {}'
+            raise RuntimeError(msg.format(frame.shape, self.shape))
+        count = len(self)
+        if self.records is None or count == len(self.records):
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.header_dtype.itemsize +
+                           (count + self.grow_records) * self.dtype.itemsize)
+            self.map_records()
+        record = self.records[count]
+        record['timestamp'] = time.monotonic() if timestamp is None else timestamp
+        record['frame'] = frame
+        self.header['count'] = count + 1
+
+    def close(self):
+        """Flush the frames and trim the file to them"""
+        if self.mode == 'r+':
+            if self.records is not None:
+                self.records.flush()
+            self.header.flush()
+            self.records = None
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.header_dtype.itemsize + len(self) * self.dtype.itemsize)
+        self.records = None
+
+
+def store_recording(path, store_path):
+    """Decode a recorded stream (see ReplayVideo) once into a FrameStore"""
+    source = ReplayVideo(path)
+    store = None
+    frame_id = 0
+    while True:
+        result = source.wait_for_next_frame(frame_id)
+        if result is None:
+            break
+        frame_id, timestamp, frame = result
+        if store is None:
+            store = FrameStore(store_path, 'w', frame.shape)
+        store.append(frame, timestamp)
+    source.stop()
+    if store is not None:
+        store.close()
+    return frame_id
+
+
+class SharedFrameRing:
+    """A ring of frame slots in shared memory, written by one process and
+read by others. Each write fills the slot after the latest frame and
+then publishes it, so a reader always gets the most recent complete
+frame without blocking the writer.
+
+The header holds the sequence number of the latest frame and, for each
+slot, the sequence number, size and timestamp of the frame stored in
+it. Sequence numbers count up from 1 and serve as frame ids. A reader
+copies a slot and then checks that its sequence number is unchanged;
+if the writer reused the slot in the meantime it reads again.
+
+Create the ring with name=None in one process, then attach to it from
+another process with the name of its shared memory (ring.memory.name).
+
+    """
+    def __init__(self, shape=(720, 960, 3), slots=3, name=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        header_size = 8 * (1 + 4 * slots)
+        frame_size = int(np.prod(self.shape))
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True,
+                                                     size=header_size + slots * frame_size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+
+        # latest sequence number, then (sequence number, height, width,
+        # timestamp in ns) per slot
+        self.header = np.ndarray((1 + 4 * slots,), dtype=np.int64,
+                                 buffer=self.memory.buf)
+        self.slot_info = self.header[1:].reshape((slots, 4))
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8,
+                                 buffer=self.memory.buf, offset=header_size)
+        if name is None:
+            self.header[:] = 0
+
+    def latest(self):
+        """Sequence number of the latest frame written, 0 if none yet"""
+        return int(self.header[0])
+
+    def fit(self, frame):
+        """The frame, scaled down if it's larger than the ring's frames, or
+None if it has the wrong number of channels"""
+        height, width, channels = self.shape
+        if frame.shape[2:] != (channels,):
+            return None
+        if frame.shape[0] <= height and frame.shape[1] <= width:
+            return frame
+        factor = min(height / frame.shape[0], width / frame.shape[1])
+        size = (min(width, int(frame.shape[1] * factor)), min(height, int(frame.shape[0] * factor)))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def write(self, frame):
+        """Copy the frame into the next slot and publish it as the latest
+frame, timestamped with time.monotonic_ns() which is comparable
+between processes. The frame must fit the ring, see fit()."""
+        timestamp = time.monotonic_ns()
+        seq = self.latest() + 1
+        slot = seq % self.slots
+        height, width = frame.shape[:2]
+        info = self.slot_info[slot]
+        info[0] = -1 # mark the slot as being written
+        self.frames[slot, :height, :width] = frame
+        info[1] = height
+        info[2] = width
+        info[3] = timestamp
+        info[0] = seq
+        self.header[0] = seq
+        return seq
+
+    def read(self):
+        """Return (sequence number, timestamp (s), copy of the latest
+frame), or (0, None, None) if nothing has been written yet"""
+        while True:
+            seq = self.latest()
+            if seq == 0:
+                return 0, None, None
+            info = self.slot_info[seq % self.slots]
+            height, width, timestamp = int(info[1]), int(info[2]), int(info[3])
+            frame = self.frames[seq % self.slots, :height, :width].copy()
+            if info[0] == seq:
+                return seq, timestamp / 1e9, frame
+
+    def close(self):
+        """Detach from the shared memory"""
+        # drop our views of the buffer, otherwise it can't be closed
+        self.header = self.slot_info = self.frames = None
+        self.memory.close()
+
+    def unlink(self):
+        """Free the shared memory, call once from the creating process"""
+        self.memory.unlink()
+
+
+class RingVideo(Video):
+    """Video receiver that runs inside the decode process of ProcessVideo.
+Decoded frames are converted to BGR and written to a SharedFrameRing
+instead of being kept in self.frame.
+
+The socket times out every receive_timeout seconds so that the process
+notices it's been stopped, and exits cleanly, even when the stream has
+stopped coming.
+
+    """
+    receive_timeout = 0.5
+
+    def __init__(self, ring, frame_ready, running, ip='0.0.0.0', port=11111, recorder=None):
+        self.open_stream(ip, port)
+        self.socket_video.settimeout(self.receive_timeout)
+        self.recorder = recorder
+        self.ring = ring
+        self.frame_ready = frame_ready
+        self.running = running
+
+    @property
+    def capturing(self):
+        return self.running.is_set()
+
+    def set_frame(self, frame):
+        frame = self.ring.fit(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        with self.frame_ready:
+            self.ring.write(frame)
+            self.frame_ready.notify_all()
+
+
+def decode_process(ring_name, shape, slots, frame_ready, running, ip, port, record=None):
+    """Entry point of the decode process started by ProcessVideo"""
+    ring = SharedFrameRing(shape, slots, name=ring_name)
+    flight_recorder = recorder.FlightRecorder(record) if record else None
+    video = None
+    try:
+        video = RingVideo(ring, frame_ready, running, ip, port, flight_recorder)
+        video.recv_video()
+    finally:
+        if video is not None:
+            video.socket_video.close()
+        ring.close()
+        if flight_recorder:
+            flight_recorder.close()
+
+
+class ProcessVideo(FrameSource):
+    """Receives and decodes the video stream in a separate process, so
+that decoding doesn't compete for the GIL with recognition and flight
+control. Frames are published through a SharedFrameRing, whose
+sequence numbers are the frame ids, and a condition shared with the
+decode process signals new frames.
+
+shape is the largest frame (height, width, channels) the drone sends.
+If record is set, the decode process records the access units to a
+recorder.FlightRecorder log of that name.
+
+    """
+    def __init__(self, ip='0.0.0.0', port=11111, shape=(720, 960, 3), slots=3, record=None):
+        self.ring = SharedFrameRing(shape, slots)
+        self.frame_ready = multiprocessing.Condition()
+        self.running = multiprocessing.Event()
+        self.running.set()
+        self.process = multiprocessing.Process(target=decode_process,
+                                               args=(self.ring.memory.name, shape, slots,
+                                                     self.frame_ready, self.running, ip, port,
+                                                     record),
+                                               daemon=True)
+        self.process.start()
+
+    def wait_for_next_frame(self, after_id=0, timeout=None):
+        with self.frame_ready:
+            if not self.frame_ready.wait_for(lambda: self.ring.latest() > after_id, timeout):
+                return None
+        return self.ring.read()
+
+    def stop(self):
+        self.running.clear()
+        # the process notices within RingVideo.receive_timeout, give it time
+        # to write the rest of its log before giving up on it
+        self.process.join(RingVideo.receive_timeout + 5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.ring.close()
+        self.ring.unlink()
+
+
+def display_process(ring_name, shape, interval):
+    """Entry point of the display process started by VideoDisplayer: show
+the latest frame in the ring every interval (ms)"""
+    ring = SharedFrameRing(shape, slots=2, name=ring_name)
+    while ring.latest() == 0:
+        time.sleep(0.1)
+    last_seq, _, frame = ring.read()
+
+    fig = plt.figure()
+    fig.canvas.set_window_title('VideoStream')
+    # frames are BGR, reverse the channels for matplotlib without copying
+    im = plt.imshow(frame[:, :, ::-1], animated=True)
+    fig.gca().axis('off')
+    fig.tight_layout(pad=0)
+
+    def update(*args):
+        nonlocal last_seq
+        if ring.latest() != last_seq:
+            last_seq, _, frame = ring.read()
+            im.set_array(frame[:, :, ::-1])
+        return im,
+
+    anim = animation.FuncAnimation(fig, update, interval=interval, blit=True)
+    plt.show()
+
+
 class VideoDisplayer:
-    def __init__(self, video):
+    """Displays video frames in a separate matplotlib process. Frames are
+written into a double-buffered SharedFrameRing that the display process
+maps directly, so frames are never pickled or sent through a pipe. When
+the display is slower than the sender it shows the latest frame and
+the others are dropped.
+
+A sender thread streams the video's frames at up to fps frames per
+second, always sending the newest frame and never the same frame
+twice. pause() and resume() stop and restart the streaming, e.g. while
+frames are sent by hand with send_single_frame(), which is safe to
+call from any thread while the streaming runs. The attribute stats
+counts frames delivered to the display, frames dropped because a newer
+one replaced them or they came too soon after the last, and
+duplicates: ticks where no new frame had arrived so nothing was sent.
+stop() ends the streaming and the display process and frees the ring;
+call it before stopping the video.
+
+shape is the largest frame (height, width, channels) to display,
+larger frames are scaled down to fit and frames with other channels
+are dropped.
+
+    """
+    def __init__(self, video, shape=(720, 960, 3), fps=30):
         self.video = video
-        self.recv_pipe, self.send_pipe = multiprocessing.Pipe(duplex=False)
-        self.receiver = multiprocessing.Process(target=self.recv,
+        self.ring = SharedFrameRing(shape, slots=2)
+        self.send_interval = 1 / fps
+        self.last_send = 0
+        self.stats = {'delivered': 0, 'dropped': 0, 'duplicate': 0}
+        # the ring has a single writer, the sender thread and callers of
+        # send_single_frame() take turns
+        self.send_lock = threading.Lock()
+        self.receiver = multiprocessing.Process(target=display_process,
+                                                args=(self.ring.memory.name, shape,
+                                                      1000 * self.send_interval),
                                                 daemon=True)
         self.receiver.start()
 
-        self.paused = False
+        self.stopped = threading.Event()
+        self.streaming = threading.Event()
+        self.streaming.set()
         self.sender = threading.Thread(target=self.send_frames, daemon=True)
         self.sender.start()
 
+    def stop(self):
+        """Stop streaming, close the display and free the shared memory"""
+        self.stopped.set()
+        self.streaming.set() # wake the sender if it's paused
+        self.sender.join()
+        self.receiver.terminate()
+        self.receiver.join()
+        self.ring.close()
+        self.ring.unlink()
+
     def pause(self):
-        self.paused = True
+        """Stop streaming the video's frames to the display"""
+        self.streaming.clear()
 
     def resume(self):
-        self.paused = False
+        """Restart streaming the video's frames to the display"""
+        self.streaming.set()
         
     def send_single_frame(self, frame):
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        self.send_pipe.send(frame)        
-        
+        """Send a BGR frame to the display unless the last one was sent too
+recently. Returns True if the frame was sent."""
+        with self.send_lock:
+            now = time.monotonic()
+            if now - self.last_send < self.send_interval:
+                self.stats['dropped'] += 1
+                return False
+            frame = self.ring.fit(frame)
+            if frame is None:
+                self.stats['dropped'] += 1
+                return False
+            self.last_send = now
+            self.ring.write(frame)
+            self.stats['delivered'] += 1
+            return True
+
     def send_frames(self):
-        while not self.paused:
-            self.send_single_frame(self.video.get_frame())
-        
-    def recv_frame(self):
-        return self.recv_pipe.recv()
-    
-    def recv(self):
-        fig = plt.figure()
-        fig.canvas.set_window_title('VideoStream')
-        self.im = plt.imshow(self.recv_frame(), animated=True)
-        fig.gca().axis('off')
-        fig.tight_layout(pad=0)
-        anim = animation.FuncAnimation(fig, self.update, interval=25, blit=True)
-        plt.show()
-        
-    def update(self, *args):
-        frame = self.recv_frame()
-        self.im.set_array(frame)
-        return self.im,
+        """Stream the latest video frame to the display at the target rate"""
+        last_id = 0
+        while not self.stopped.is_set():
+            if not self.streaming.is_set():
+                self.streaming.wait()
+                last_id = 0 # frames skipped while paused weren't dropped
+                continue
 
-        
+            # wait for the next send slot, newer frames replace older ones
+            time.sleep(max(0, self.last_send + self.send_interval - time.monotonic()))
+            result = self.video.wait_for_next_frame(last_id, timeout=self.send_interval)
+            if not self.streaming.is_set():
+                continue # paused while waiting, the frame is someone else's to send
+            if result is None:
+                with self.send_lock:
+                    self.stats['duplicate'] += 1
+                continue
+
+            frame_id, _, frame = result
+            if last_id:
+                with self.send_lock:
+                    self.stats['dropped'] += frame_id - last_id - 1
+            last_id = frame_id
+            self.send_single_frame(frame)